@@ -5,15 +5,32 @@
 # Fully supports User-Password authentication (PEAP+MSChapV2)
 # Supports reply attributes needed by Ubiquiti equipment for VLAN assignment
 import radiusd
+import collections
+import hashlib
 import json
 import logging
 import os
 import threading
-import uuid
+import time
+import itertools
 import random
 import sys
+import atexit
+import binascii
+import mmap
+import sqlite3
+import struct
+import zlib
 from ctypes import *
 from logging.handlers import TimedRotatingFileHandler
+try:
+  import queue
+except ImportError:
+  import Queue as queue
+try:
+  import numpy
+except ImportError:
+  numpy = None
 
 # json keys
 PASS_KEY = "pass"
@@ -27,6 +44,18 @@ WILDCARD_KEY = "wildcard"
 _IS_BYPASS = "isbypass"
 rlock = threading.RLock()
 logger = None
+_config_lock = threading.Lock()
+_snapshot = None
+_failed_signature = None
+_reloads = 0
+_key_state = None
+_CRED_CACHE_SIZE = 4096
+_CONVERSATION_SIZE = 4096
+_CONVERSATION_TTL = 30
+_CORRELATE_SIZE = 65536
+_CORRELATE_TTL = 3600
+_ID_PREFIX = "{0:x}.{1:x}".format(int(time.time()), os.getpid())
+_sequence = itertools.count(1)
 _CONFIG_FILE_NAME="network.json"
 _PY_CONF = '/etc/raddb/mods-config/python/'
 _CONFIG_FILE = _PY_CONF + _CONFIG_FILE_NAME
@@ -37,7 +66,72 @@ _ENC_KEY_FILE = _PY_CONF + 'keyfile'
 _ENC_DELIMITER = "."
 _ENC_KEY = "|"
 _ENC_PAD = ord(":")
+_TEA_DELTA = 0x9E3779B9
+_TEA_DECRYPT_SUM = 0xC6EF3720
+_UINT32 = 0xFFFFFFFF
 _ISPY2 = sys.version_info < (3, 0)
+_HEX = frozenset("0123456789abcdef")
+# shortest wildcard (mac fragment) honored, an OUI
+_WILDCARD_MIN = 6
+# binary (mmap) config layout, all little-endian:
+# header, users (sorted by name), user macs, vlans (sorted by name),
+# bypass/port macs (sorted by mac, kind), wildcards, string pool
+_BIN_MAGIC = b"FPYC"
+_BIN_VERSION = 1
+_BIN_HEADER = struct.Struct("<4sHHIIIIIII")
+_BIN_USER = struct.Struct("<IIIIII")
+_BIN_MAC = 6
+_BIN_VLAN = struct.Struct("<IIII")
+_BIN_BYPASS = struct.Struct("<6sBxII")
+_BIN_WILDCARD = struct.Struct("<IIII")
+_BIN_KIND_BYPASS = 1
+_BIN_KIND_PORT = 2
+# sqlite config
+_SQL_MAGIC = b"SQLite format 3\x00"
+_SQL_MMAP = 256 * 1024 * 1024
+_SQL_TABLES = collections.OrderedDict([
+  ("users", ["name TEXT NOT NULL PRIMARY KEY", "pass TEXT NOT NULL"]),
+  ("macs", ["user TEXT NOT NULL", "mac TEXT NOT NULL"]),
+  ("bypass", ["mac TEXT NOT NULL",
+              "kind INTEGER NOT NULL",
+              "vlan TEXT NOT NULL"]),
+  ("wildcards", ["fragment TEXT NOT NULL PRIMARY KEY", "vlan TEXT NOT NULL"]),
+  ("vlans", ["name TEXT NOT NULL PRIMARY KEY", "num TEXT NOT NULL"])])
+_SQL_INDEXES = [
+  "CREATE UNIQUE INDEX IF NOT EXISTS macs_user ON macs (user, mac)",
+  "CREATE UNIQUE INDEX IF NOT EXISTS bypass_mac ON bypass (mac, kind)"]
+# trace logging (queued, written by a background thread)
+_TRACE_QUEUE_SIZE = 10000
+_TRACE_BATCH_SIZE = 256
+_TRACE_BLOCK = 0
+# trace line format: "text" (<asctime> STAGE:id -> data) or "json" (JSONL)
+_LOG_TEXT = "text"
+_LOG_JSON = "json"
+_LOG_FORMAT = _LOG_TEXT
+_writer = None
+# stdout echo of requests per stage (e.g. _ECHO["AUTHORIZE"] = False)
+_ECHO = {}
+_ECHO_DEFAULT = True
+# (user, mac) -> last accept/reject, flushed to sqlite by a background thread
+_SEEN_FILE_NAME = 'seen.db'
+_SEEN_FILE = "/var/log/radius/freepydius/" + _SEEN_FILE_NAME
+_SEEN_FLUSH = 60
+_SEEN_BATCH = 1024
+_SEEN_SCHEMA = """CREATE TABLE IF NOT EXISTS seen (
+  user TEXT NOT NULL,
+  mac TEXT NOT NULL,
+  last_accept REAL,
+  last_reject REAL,
+  nas TEXT,
+  port TEXT,
+  PRIMARY KEY (user, mac))"""
+_seen = {}
+_seen_dirty = set()
+_seen_lock = threading.Lock()
+_flusher = None
+# exceptions caught (and logged) by authorize/post_auth, read by tooling
+_stage_errors = 0
+_stage_errors_lock = threading.Lock()
 
 def byteify(input):
   """make sure we get strings."""
@@ -63,46 +157,519 @@ def _convert_user_name(name):
 
 def _mac(possible_mac):
   """check if an object is a mac."""
-  valid = False
-  if len(possible_mac) == 12:
-    valid = True
-    for c in possible_mac:
-      if c not in ['0', '1', '2', '3', '4', '5', '6', '7', '8', '9', 'a', 'b', 'c', 'd', 'e', 'f']:
-        valid = False
-        break
-  return valid
-
-
-def _config(input_name):
-  """get a user config from file."""
-  user_name = _convert_user_name(input_name)
-  with open(_CONFIG_FILE) as f:
+  return len(possible_mac) == 12 and _HEX.issuperset(possible_mac)
+
+
+class _Snapshot(object):
+  """immutable, pre-indexed view of the network config (do not mutate)."""
+  def __init__(self, obj, signature, generation):
+    self.signature = signature
+    self.generation = generation
+    self.vlans = obj[VLAN_KEY]
+    self.bypass = obj[BYPASS_KEY]
+    self.users = {}
+    # user macs are frozensets (the user name selects the user), mac-auth
+    # uses port bypass mac -> vlan and wildcard (mac fragment) -> vlan
+    for name in sorted(obj[USER_KEY].keys()):
+      user = obj[USER_KEY][name]
+      indexed = dict(user)
+      indexed[MAC_KEY] = frozenset(user.get(MAC_KEY, []))
+      self.users[name] = indexed
+    tables = _mac_auth_tables(obj[USER_KEY])
+    self.port = tables[0]
+    self.wildcards = tables[1]
+    self.wildcard_lengths = sorted(set(len(x) for x in self.wildcards),
+                                   reverse=True)
+    self.replies = {}
+    for vlan in self.vlans.values():
+      self.replies[vlan] = _vlan_reply(vlan)
+
+  def user(self, name):
+    """get a user definition by name."""
+    return self.users.get(name)
+
+  def vlan(self, name):
+    """get a vlan (number) by name."""
+    return self.vlans.get(name)
+
+  def mac_bypass(self, mac):
+    """vlan name for a mac-auth: bypass, then port bypass, then wildcard."""
+    vlan = self.bypass.get(mac)
+    if vlan is None:
+      vlan = self.port.get(mac)
+    if vlan is None:
+      vlan = _wildcard(self.wildcards, self.wildcard_lengths, mac)
+    return vlan
+
+
+def _wildcard_fragment(possible):
+  """a wildcard as a mac fragment (None if too short or not hex)."""
+  fragment = _convert_mac(possible)
+  if len(fragment) < _WILDCARD_MIN or len(fragment) > 12 or \
+     not _HEX.issuperset(fragment):
+    return None
+  return fragment
+
+
+def _mac_auth_tables(users):
+  """port bypass mac -> vlan and wildcard -> vlan (first user by name)."""
+  ports = {}
+  wildcards = {}
+  for name in sorted(users.keys()):
+    user = users[name]
+    vlan = name.split(".")[0]
+    for mac in user.get(PORT_BYPASS_KEY, []):
+      ports.setdefault(_convert_mac(mac), vlan)
+    for wildcard in user.get(WILDCARD_KEY, []):
+      fragment = _wildcard_fragment(wildcard)
+      if fragment is not None:
+        wildcards.setdefault(fragment, vlan)
+  return (ports, wildcards)
+
+
+def _wildcard(wildcards, lengths, mac):
+  """vlan of the longest (then left-most) wildcard fragment in a mac."""
+  size = len(mac)
+  for length in lengths:
+    for start in range(0, size - length + 1):
+      vlan = wildcards.get(mac[start:start + length])
+      if vlan is not None:
+        return vlan
+  return None
+
+
+class _LRU(object):
+  """bounded, thread-safe least-recently-used cache tied to a generation."""
+  def __init__(self, size, ttl=None):
+    self.size = size
+    self.ttl = ttl
+    self.generation = None
+    self._items = collections.OrderedDict()
+    self._lock = threading.Lock()
+
+  def sync(self, generation):
+    """drop all entries when the generation they were built from changes."""
+    if generation == self.generation:
+      return
+    with self._lock:
+      if generation != self.generation:
+        self._items.clear()
+        self.generation = generation
+
+  def get(self, key):
+    """get an entry (None if missing), marking it recently used."""
+    with self._lock:
+      if key not in self._items:
+        return None
+      entry = self._items.pop(key)
+      if entry[0] is not None and entry[0] < time.time():
+        return None
+      self._items[key] = entry
+      return entry[1]
+
+  def put(self, key, value):
+    """add an entry, evicting the least recently used past the size."""
+    expires = None
+    if self.ttl is not None:
+      expires = time.time() + self.ttl
+    with self._lock:
+      self._items.pop(key, None)
+      self._items[key] = (expires, value)
+      while len(self._items) > self.size:
+        self._items.popitem(last=False)
+
+  def clear(self):
+    """drop all entries."""
+    with self._lock:
+      self._items.clear()
+
+
+_credentials = _LRU(_CRED_CACHE_SIZE)
+_conversations = _LRU(_CONVERSATION_SIZE, ttl=_CONVERSATION_TTL)
+_correlations = _LRU(_CORRELATE_SIZE, ttl=_CORRELATE_TTL)
+
+
+def _utf8(text):
+  """text as utf-8 bytes."""
+  if isinstance(text, bytes):
+    return text
+  return text.encode("utf-8")
+
+
+def _text(raw):
+  """utf-8 bytes as (native) text."""
+  if _ISPY2:
+    return raw
+  return raw.decode("utf-8")
+
+
+def _pack_config(obj):
+  """pack a (composed) config object into the binary config layout."""
+  pool = bytearray()
+  refs = {}
+
+  def ref(text):
+    raw = _utf8(text)
+    if raw not in refs:
+      refs[raw] = (len(pool), len(raw))
+      pool.extend(raw)
+    return refs[raw]
+  users = obj[USER_KEY]
+  vlans = obj[VLAN_KEY]
+  user_recs = []
+  user_macs = []
+  ports, wildcards = _mac_auth_tables(users)
+  for name in sorted(users.keys(), key=_utf8):
+    user = users[name]
+    macs = sorted(set(user.get(MAC_KEY, [])))
+    name_ref = ref(name)
+    pass_ref = ref(user.get(PASS_KEY, ""))
+    user_recs.append(_BIN_USER.pack(name_ref[0], name_ref[1],
+                                    pass_ref[0], pass_ref[1],
+                                    len(user_macs), len(macs)))
+    user_macs += [binascii.unhexlify(_utf8(m)) for m in macs]
+  vlan_recs = []
+  for name in sorted(vlans.keys(), key=_utf8):
+    name_ref = ref(name)
+    num_ref = ref(vlans[name])
+    vlan_recs.append(_BIN_VLAN.pack(name_ref[0], name_ref[1],
+                                    num_ref[0], num_ref[1]))
+  entries = []
+  for kind, table in [(_BIN_KIND_BYPASS, obj[BYPASS_KEY]),
+                      (_BIN_KIND_PORT, ports)]:
+    for mac in table:
+      entries.append((binascii.unhexlify(_utf8(mac)), kind, table[mac]))
+  mac_recs = []
+  for entry in sorted(entries):
+    vlan_ref = ref(entry[2])
+    mac_recs.append(_BIN_BYPASS.pack(entry[0], entry[1],
+                                     vlan_ref[0], vlan_ref[1]))
+  wild_recs = []
+  for fragment in sorted(wildcards.keys()):
+    frag_ref = ref(fragment)
+    vlan_ref = ref(wildcards[fragment])
+    wild_recs.append(_BIN_WILDCARD.pack(frag_ref[0], frag_ref[1],
+                                        vlan_ref[0], vlan_ref[1]))
+  body = b"".join(user_recs + user_macs + vlan_recs + mac_recs + wild_recs)
+  body = body + bytes(pool)
+  header = _BIN_HEADER.pack(_BIN_MAGIC,
+                            _BIN_VERSION,
+                            0,
+                            zlib.crc32(body) & _UINT32,
+                            len(user_recs),
+                            len(user_macs),
+                            len(vlan_recs),
+                            len(mac_recs),
+                            len(wild_recs),
+                            len(pool))
+  return header + body
+
+
+class _BinarySnapshot(object):
+  """mmap-backed config snapshot, searched in place (do not mutate)."""
+  def __init__(self, path, signature, generation):
+    self.signature = signature
+    self.generation = generation
+    with open(path, 'rb') as f:
+      self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    header = _BIN_HEADER.unpack_from(self._map, 0)
+    if header[0] != _BIN_MAGIC or header[1] != _BIN_VERSION:
+      raise Exception("unsupported binary config")
+    counts = header[4:]
+    self._users = _BIN_HEADER.size
+    self._user_macs = self._users + counts[0] * _BIN_USER.size
+    self._vlans = self._user_macs + counts[1] * _BIN_MAC
+    self._macs = self._vlans + counts[2] * _BIN_VLAN.size
+    self._wildcards = self._macs + counts[3] * _BIN_BYPASS.size
+    self._pool = self._wildcards + counts[4] * _BIN_WILDCARD.size
+    if self._pool + counts[5] != len(self._map):
+      raise Exception("truncated binary config")
+    if zlib.crc32(self._map[_BIN_HEADER.size:]) & _UINT32 != header[3]:
+      raise Exception("binary config checksum mismatch")
+    self._counts = counts
+    self.wildcards = {}
+    for idx in range(0, counts[4]):
+      rec = _BIN_WILDCARD.unpack_from(self._map,
+                                      self._wildcards +
+                                      idx * _BIN_WILDCARD.size)
+      self.wildcards[self._string(rec[0], rec[1])] = \
+          self._string(rec[2], rec[3])
+    self.wildcard_lengths = sorted(set(len(x) for x in self.wildcards),
+                                   reverse=True)
+    self.replies = {}
+    for idx in range(0, counts[2]):
+      rec = _BIN_VLAN.unpack_from(self._map,
+                                  self._vlans + idx * _BIN_VLAN.size)
+      vlan = self._string(rec[2], rec[3])
+      self.replies[vlan] = _vlan_reply(vlan)
+
+  def _raw(self, offset, length):
+    """raw bytes from the string pool."""
+    start = self._pool + offset
+    return self._map[start:start + length]
+
+  def _string(self, offset, length):
+    """text from the string pool."""
+    return _text(self._raw(offset, length))
+
+  def _search(self, base, rec, count, key):
+    """binary search a table sorted by its first (pool string) field."""
+    lo = 0
+    hi = count
+    while lo < hi:
+      mid = (lo + hi) // 2
+      fields = rec.unpack_from(self._map, base + mid * rec.size)
+      current = self._raw(fields[0], fields[1])
+      if current < key:
+        lo = mid + 1
+      elif current > key:
+        hi = mid
+      else:
+        return fields
+    return None
+
+  def user(self, name):
+    """get a user definition by name."""
+    fields = self._search(self._users, _BIN_USER, self._counts[0],
+                          _utf8(name))
+    if fields is None:
+      return None
+    macs = []
+    for idx in range(fields[4], fields[4] + fields[5]):
+      start = self._user_macs + idx * _BIN_MAC
+      macs.append(_text(binascii.hexlify(self._map[start:start + _BIN_MAC])))
+    return { PASS_KEY: self._string(fields[2], fields[3]),
+             MAC_KEY: frozenset(macs) }
+
+  def vlan(self, name):
+    """get a vlan (number) by name."""
+    fields = self._search(self._vlans, _BIN_VLAN, self._counts[2],
+                          _utf8(name))
+    if fields is None:
+      return None
+    return self._string(fields[2], fields[3])
+
+  def mac_bypass(self, mac):
+    """vlan name for a mac-auth: bypass, then port bypass, then wildcard."""
+    key = binascii.unhexlify(_utf8(mac))
+    lo = 0
+    hi = self._counts[3]
+    while lo < hi:
+      mid = (lo + hi) // 2
+      start = self._macs + mid * _BIN_BYPASS.size
+      if self._map[start:start + _BIN_MAC] < key:
+        lo = mid + 1
+      else:
+        hi = mid
+    if lo < self._counts[3]:
+      fields = _BIN_BYPASS.unpack_from(self._map,
+                                       self._macs + lo * _BIN_BYPASS.size)
+      if fields[0] == key:
+        return self._string(fields[2], fields[3])
+    return _wildcard(self.wildcards, self.wildcard_lengths, mac)
+
+
+def _sql_rows(obj):
+  """rows, per sqlite table, for a (composed) config object."""
+  users = obj[USER_KEY]
+  ports, wildcards = _mac_auth_tables(users)
+  rows = {}
+  rows["users"] = set((n, users[n].get(PASS_KEY, "")) for n in users)
+  rows["macs"] = set((n, m) for n in users
+                     for m in users[n].get(MAC_KEY, []))
+  rows["bypass"] = set((m, _BIN_KIND_BYPASS, v)
+                       for m, v in obj[BYPASS_KEY].items())
+  rows["bypass"].update((m, _BIN_KIND_PORT, v) for m, v in ports.items())
+  rows["wildcards"] = set(wildcards.items())
+  rows["vlans"] = set(obj[VLAN_KEY].items())
+  return rows
+
+
+def _sync_sqlite(path, obj):
+  """apply only the changed rows of a config object to a sqlite config."""
+  rows = _sql_rows(obj)
+  changes = collections.OrderedDict()
+  conn = sqlite3.connect(path)
+  try:
+    conn.execute("PRAGMA journal_mode=WAL")
+    with conn:
+      for table, columns in _SQL_TABLES.items():
+        conn.execute("CREATE TABLE IF NOT EXISTS {0} ({1})".format(
+          table, ", ".join(columns)))
+      for index in _SQL_INDEXES:
+        conn.execute(index)
+      for table, columns in _SQL_TABLES.items():
+        names = [c.split(" ")[0] for c in columns]
+        selected = conn.execute("SELECT {0} FROM {1}".format(
+          ", ".join(names), table))
+        existing = set(tuple(r) for r in selected)
+        removed = existing - rows[table]
+        added = rows[table] - existing
+        where = " AND ".join("{0} = ?".format(n) for n in names)
+        conn.executemany("DELETE FROM {0} WHERE {1}".format(table, where),
+                         sorted(removed))
+        conn.executemany("INSERT INTO {0} ({1}) VALUES ({2})".format(
+          table, ", ".join(names), ", ".join("?" for n in names)),
+          sorted(added))
+        changes[table] = (len(added), len(removed))
+      if any(sum(c) > 0 for c in changes.values()):
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        conn.execute("PRAGMA user_version = {0}".format(version + 1))
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+  finally:
+    conn.close()
+  os.utime(path, None)
+  return changes
+
+
+class _SqliteSnapshot(object):
+  """sqlite-backed config snapshot, indexed point queries (read-only)."""
+  def __init__(self, path, signature, generation):
+    self.signature = signature
+    self.generation = generation
+    self.path = path
+    self._local = threading.local()
+    conn = self._conn()
+    self.wildcards = dict(conn.execute("SELECT fragment, vlan "
+                                       "FROM wildcards"))
+    self.wildcard_lengths = sorted(set(len(x) for x in self.wildcards),
+                                   reverse=True)
+    self.replies = {}
+    for row in conn.execute("SELECT num FROM vlans"):
+      self.replies[row[0]] = _vlan_reply(row[0])
+
+  def _conn(self):
+    """this thread's read-only connection."""
+    conn = getattr(self._local, "conn", None)
+    if conn is None:
+      try:
+        conn = sqlite3.connect("file:{0}?mode=ro".format(self.path),
+                               uri=True)
+      except TypeError:
+        conn = sqlite3.connect(self.path)
+      conn.execute("PRAGMA query_only = 1")
+      conn.execute("PRAGMA mmap_size = {0}".format(_SQL_MMAP))
+      if _ISPY2:
+        conn.text_factory = str
+      self._local.conn = conn
+    return conn
+
+  def user(self, name):
+    """get a user definition by name."""
+    conn = self._conn()
+    row = conn.execute("SELECT pass FROM users WHERE name = ?",
+                       (name,)).fetchone()
+    if row is None:
+      return None
+    macs = conn.execute("SELECT mac FROM macs WHERE user = ?", (name,))
+    return { PASS_KEY: row[0], MAC_KEY: frozenset(m[0] for m in macs) }
+
+  def vlan(self, name):
+    """get a vlan (number) by name."""
+    row = self._conn().execute("SELECT num FROM vlans WHERE name = ?",
+                               (name,)).fetchone()
+    if row is None:
+      return None
+    return row[0]
+
+  def mac_bypass(self, mac):
+    """vlan name for a mac-auth: bypass, then port bypass, then wildcard."""
+    row = self._conn().execute("SELECT vlan FROM bypass WHERE mac = ? "
+                               "ORDER BY kind LIMIT 1", (mac,)).fetchone()
+    if row is not None:
+      return row[0]
+    return _wildcard(self.wildcards, self.wildcard_lengths, mac)
+
+
+def _signature(path):
+  """file identity used to detect config changes."""
+  st = os.stat(path)
+  return (path, st.st_ino, st.st_size, st.st_mtime)
+
+
+def _load_snapshot(path, signature, generation):
+  """parse and index a config file (json, binary or sqlite)."""
+  with open(path, 'rb') as f:
+    magic = f.read(len(_SQL_MAGIC))
+  if magic.startswith(_BIN_MAGIC):
+    return _BinarySnapshot(path, signature, generation)
+  if magic == _SQL_MAGIC:
+    return _SqliteSnapshot(path, signature, generation)
+  with open(path) as f:
     if _ISPY2:
       obj = byteify(json.loads(f.read()))
     else:
       obj = json.loads(f.read())
-    users = obj[USER_KEY]
-    vlans = obj[VLAN_KEY]
-    bypass = obj[BYPASS_KEY]
-    user_obj = None
-    vlan_obj = None
-    if "." in user_name:
-      parts = user_name.split(".")
-      vlan = parts[0]
-      if user_name in users:
-        user_obj = users[user_name]
-      if vlan in vlans:
-        vlan_obj = vlans[vlan]
-    else:
-      lowered = user_name.lower()
-      valid = _mac(lowered)
-      if valid and lowered in bypass:
-        vlan_name = bypass[lowered]
-        if vlan_name in vlans:
+  return _Snapshot(obj, signature, generation)
+
+
+def _current():
+  """get the current snapshot, swapping in a changed config file."""
+  global _snapshot
+  global _failed_signature
+  global _reloads
+  snapshot = _snapshot
+  try:
+    signature = _signature(_CONFIG_FILE)
+  except OSError:
+    if snapshot is None:
+      raise
+    return snapshot
+  if snapshot is not None and snapshot.signature == signature:
+    return snapshot
+  if snapshot is not None and signature == _failed_signature:
+    return snapshot
+  with _config_lock:
+    snapshot = _snapshot
+    if snapshot is not None and snapshot.signature == signature:
+      return snapshot
+    generation = 1
+    if snapshot is not None:
+      generation = snapshot.generation + 1
+    try:
+      loaded = _load_snapshot(_CONFIG_FILE, signature, generation)
+    except Exception as e:
+      if snapshot is None:
+        raise
+      _failed_signature = signature
+      Log("RELOAD").log(( ('Response', 'failed'), ('Error', str(e)), ))
+      return snapshot
+    _snapshot = loaded
+    _failed_signature = None
+    _reloads = _reloads + 1
+    Log("RELOAD").log(( ('Response', 'reloaded'),
+                        ('Generation', generation),
+                        ('Reloads', _reloads), ))
+    return loaded
+
+
+def _config(input_name, snapshot=None):
+  """get a user config from the (current) snapshot."""
+  user_name = _convert_user_name(input_name)
+  if snapshot is None:
+    snapshot = _current()
+  return _find(user_name, input_name, snapshot)
+
+
+def _find(user_name, input_name, snapshot):
+  """find the user and vlan for a (converted) user name."""
+  user_obj = None
+  vlan_obj = None
+  if "." in user_name:
+    parts = user_name.split(".")
+    vlan = parts[0]
+    user_obj = snapshot.user(user_name)
+    vlan_obj = snapshot.vlan(vlan)
+  else:
+    lowered = user_name.lower()
+    if _mac(lowered):
+      vlan_name = snapshot.mac_bypass(lowered)
+      if vlan_name is not None:
+        vlan_obj = snapshot.vlan(vlan_name)
+        if vlan_obj is not None:
           # input_name (User-Name) HAS to == "pass"
-          user_obj = { PASS_KEY: input_name, MAC_KEY: [lowered], _IS_BYPASS: True }
-          vlan_obj = vlans[vlan_name]
-    return (user_obj, vlan_obj)
+          user_obj = { PASS_KEY: input_name, MAC_KEY: frozenset([lowered]), _IS_BYPASS: True }
+  return (user_obj, vlan_obj)
 
 
 def _convert_key(key):
@@ -112,8 +679,29 @@ def _convert_key(key):
 
 def _get_tea_key():
   """Get the TEA key from keyfile."""
-  with open(_ENC_KEY_FILE, 'r') as f:
-    return _convert_key(f.read().strip())
+  return _tea_key_state()[2]
+
+
+def _tea_key_state():
+  """Get (signature, digest, key) for the keyfile, re-read on change."""
+  global _key_state
+  signature = _signature(_ENC_KEY_FILE)
+  state = _key_state
+  if state is None or state[0] != signature:
+    with open(_ENC_KEY_FILE, 'r') as f:
+      raw = f.read().strip()
+    digest = hashlib.sha256(raw.encode("utf-8")).hexdigest()
+    state = (signature, digest, _convert_key(raw))
+    _key_state = state
+  return state
+
+
+def _key_digest():
+  """keyfile digest for cache generations (None when it can't be read)."""
+  try:
+    return _tea_key_state()[1]
+  except (IOError, OSError):
+    return None
 
 
 def _split_key(key):
@@ -183,6 +771,106 @@ def _decrypt(v, key_input):
   return "".join(resulting)
 
 
+def _encrypt_many(values, key_input):
+  """encrypt many values in one pass (same output as _encrypt each)."""
+  for v in values:
+    if len(v) % 2 != 0:
+      raise Exception("value must be divisible by 2")
+  key_parts = _split_key(key_input)
+  key = key_parts[1]
+  pad = key_parts[0]
+  blocks = []
+  keys = []
+  for v in values:
+    for i in range(0, len(v), 2):
+      blocks.append((ord(v[i]), ord(v[i + 1])))
+      keys.append(key[i:i+4])
+  results = iter(_tea_many(blocks, keys, False))
+  encrypted = []
+  for v in values:
+    resulting = []
+    for i in range(0, len(v), 2):
+      res = next(results)
+      f_pad = _pad(pad, res[0])
+      l_pad = _pad(pad, res[1])
+      resulting.append("{}{}{}".format(f_pad,
+                                       _ENC_DELIMITER,
+                                       l_pad))
+    encrypted.append(_ENC_KEY.join(resulting))
+  return encrypted
+
+
+def _decrypt_many(values, key_input):
+  """decrypt many values in one pass (same output as _decrypt each)."""
+  key_parts = _split_key(key_input)
+  key = key_parts[1]
+  pad = key_parts[0]
+  end_pad = -1 * pad
+  blocks = []
+  keys = []
+  counts = []
+  for v in values:
+    split = v.split(_ENC_KEY)
+    idx = 0
+    for item in split:
+      parts = item.split(_ENC_DELIMITER)
+      f_in = parts[0]
+      l_in = parts[1]
+      if end_pad != 0:
+        f_in = f_in[pad:end_pad]
+        l_in = l_in[pad:end_pad]
+      blocks.append((int(f_in), int(l_in)))
+      keys.append(key[idx:idx+4])
+      idx = idx + 2
+    counts.append(len(split))
+  results = iter(_tea_many(blocks, keys, True))
+  decrypted = []
+  for count in counts:
+    resulting = []
+    for _ in range(count):
+      res = next(results)
+      resulting.append(chr(res[0]))
+      resulting.append(chr(res[1]))
+    decrypted.append("".join(resulting))
+  return decrypted
+
+
+def _tea_many(blocks, keys, decrypt):
+  """TEA over many blocks, vectorized when numpy is available."""
+  if numpy is None or len(blocks) == 0 or min(len(k) for k in keys) < 4:
+    call = _tea_encrypt
+    if decrypt:
+      call = _tea_decrypt
+    return [call(b, k) for b, k in zip(blocks, keys)]
+  v = numpy.array([(b[0] & _UINT32, b[1] & _UINT32) for b in blocks],
+                  dtype=numpy.uint32)
+  k = numpy.array(keys, dtype=numpy.uint32)
+  y = v[:, 0].copy()
+  z = v[:, 1].copy()
+  k0 = k[:, 0]
+  k1 = k[:, 1]
+  k2 = k[:, 2]
+  k3 = k[:, 3]
+  n = 32
+  if decrypt:
+    s = _TEA_DECRYPT_SUM
+    while n > 0:
+      su = numpy.uint32(s)
+      z -= ( y << 4 ) + k2 ^ y + su ^ ( y >> 5 ) + k3
+      y -= ( z << 4 ) + k0 ^ z + su ^ ( z >> 5 ) + k1
+      s = (s - _TEA_DELTA) & _UINT32
+      n -= 1
+  else:
+    s = 0
+    while n > 0:
+      s = (s + _TEA_DELTA) & _UINT32
+      su = numpy.uint32(s)
+      y += ( z << 4 ) + k0 ^ z + su ^ ( z >> 5 ) + k1
+      z += ( y << 4 ) + k2 ^ y + su ^ ( y >> 5 ) + k3
+      n -= 1
+  return numpy.stack([y, z], axis=1).tolist()
+
+
 def _tea_encrypt(v, k):
   y = c_uint32(v[0]);
   z = c_uint32(v[1]);
@@ -216,29 +904,112 @@ def _tea_decrypt(v, k):
   w[1]=z.value
   return w
 
+def _credential(encrypted, generation):
+  """decrypt a password, once per (config generation, keyfile digest)."""
+  key_state = _tea_key_state()
+  _credentials.sync((generation, key_state[1]))
+  password = _credentials.get(encrypted)
+  if password is None:
+    password = _decrypt(encrypted, key_state[2])
+    _credentials.put(encrypted, password)
+  return password
+
+
+def _vlan_reply(vlan):
+  """reply attributes for a vlan assignment."""
+  return ( ('Tunnel-Type', 'VLAN'),
+           ('Tunnel-Medium-Type', 'IEEE-802'),
+           ('Tunnel-Private-Group-Id', vlan), )
+
+
+_Resolution = collections.namedtuple("_Resolution", ["user",
+                                                     "vlan",
+                                                     "macs",
+                                                     "bypass",
+                                                     "password",
+                                                     "reply"])
+
+
+def _resolve(input_name, credential=True, snapshot=None):
+  """resolve a user name to its vlan/macs/password in a single lookup."""
+  if snapshot is None:
+    snapshot = _current()
+  user_name = _convert_user_name(input_name)
+  config = _find(user_name, input_name, snapshot)
+  user = config[0]
+  vlan = config[1]
+  if user is None:
+    return None
+  bypass = _IS_BYPASS in user and user[_IS_BYPASS]
+  if bypass:
+    user_name = user_name.lower()
+  password = None
+  if credential and PASS_KEY in user:
+    if bypass:
+      password = user[PASS_KEY]
+    else:
+      password = _credential(user[PASS_KEY], snapshot.generation)
+  reply = None
+  if vlan is not None:
+    reply = snapshot.replies.get(vlan)
+    if reply is None:
+      reply = _vlan_reply(vlan)
+  return _Resolution(user_name,
+                     vlan,
+                     user.get(MAC_KEY, frozenset()),
+                     bypass,
+                     password,
+                     reply)
+
+
+def _matched(resolved, macs):
+  """check a resolution is assigned a vlan for any of the macs."""
+  if resolved is None or resolved.vlan is None or macs is None:
+    return False
+  return not resolved.macs.isdisjoint(macs)
+
+
+def _conversation_key(p):
+  """identify an (EAP) conversation from the request attributes."""
+  user_name = None
+  macs = []
+  nas = []
+  for item in p:
+    if item[0] == "User-Name":
+      user_name = item[1]
+    elif item[0] == "Calling-Station-Id":
+      macs.append(_convert_mac(item[1]))
+    elif item[0] in ["NAS-IP-Address", "NAS-IPv6-Address", "NAS-Identifier"]:
+      nas.append(item)
+  return (user_name, tuple(sorted(macs)), tuple(sorted(nas)))
+
+
+def _resolve_conversation(p, user_name, credential=True):
+  """resolve a user, sharing the result across a conversation's rounds."""
+  snapshot = _current()
+  _conversations.sync((snapshot.generation, _key_digest()))
+  key = _conversation_key(p)
+  cached = _conversations.get(key)
+  if cached is not None:
+    return cached[0]
+  resolved = _resolve(user_name, credential=credential, snapshot=snapshot)
+  if credential:
+    _conversations.put(key, (resolved,))
+  return resolved
+
+
 def _get_pass(user_name):
   """set the configuration for down-the-line modules."""
-  config = _config(user_name)
-  user = config[0]
-  if user is not None:
-    if PASS_KEY in user:
-      if _IS_BYPASS in user and user[_IS_BYPASS]:
-        return user[PASS_KEY]
-      else:
-        return _decrypt(user[PASS_KEY], _get_tea_key())
+  resolved = _resolve(user_name)
+  if resolved is not None:
+    return resolved.password
 
 
 def _get_vlan(user_name, macs):
   """set the reply for a user and mac."""
-  config = _config(user_name)
-  user = config[0]
-  vlan = config[1]
-  if user is not None and vlan is not None:
-    if MAC_KEY in user:
-      mac_set = user[MAC_KEY]
-      for mac in macs:
-        if mac in mac_set:
-          return vlan
+  resolved = _resolve(user_name, credential=False)
+  if _matched(resolved, macs):
+    return resolved.vlan
 
 
 def _convert_mac(mac):
@@ -265,46 +1036,292 @@ def _get_user_mac(p):
   return (user_name, mac_set)
 
 
+def _new_id():
+  """next id in this process (monotonic, cheap)."""
+  return "{0}.{1:x}".format(_ID_PREFIX, next(_sequence))
+
+
+def _correlate(cat, p):
+  """id shared by all stages (and rounds) of one login."""
+  key = _conversation_key(p)
+  ident = None
+  fresh = cat == "AUTHORIZE" and "State" not in [x[0] for x in p]
+  if not fresh:
+    ident = _correlations.get(key)
+  if ident is None:
+    ident = _new_id()
+  _correlations.put(key, ident)
+  return ident
+
+
 class Log(object):
   """logging object."""
-  def __init__(self, cat):
-    self.id = str(uuid.uuid4())
+  def __init__(self, cat, p=None):
+    if p is None:
+      self.id = _new_id()
+    else:
+      self.id = _correlate(cat, p)
     self.name = cat
 
   def log(self, params):
-    """common logging."""
-    with rlock:
-      if logger is not None:
-        logger.info("{0}:{1} -> {2}".format(self.name, self.id, params))
+    """common logging (queued, never blocks on disk)."""
+    writer = _writer
+    if writer is not None:
+      writer.submit(self.name, self.id, params)
+
+
+class _TraceWriter(threading.Thread):
+  """drains queued trace records to the logger in batches."""
+  def __init__(self, target):
+    threading.Thread.__init__(self, name="freepydius-trace")
+    self.daemon = True
+    self.target = target
+    self.queue = queue.Queue(_TRACE_QUEUE_SIZE)
+    self.written = 0
+    self.dropped = 0
+    self.batches = 0
+    self._reported = 0
+    self._drop_lock = threading.Lock()
+
+  def submit(self, name, ident, params):
+    """queue a record, dropping it if the queue stays full."""
+    item = (time.time(), name, ident, params)
+    try:
+      if _TRACE_BLOCK > 0:
+        self.queue.put(item, True, _TRACE_BLOCK)
+      else:
+        self.queue.put_nowait(item)
+    except queue.Full:
+      with self._drop_lock:
+        self.dropped = self.dropped + 1
+
+  def stop(self):
+    """write out anything queued and stop the thread."""
+    self.queue.put(None)
+    self.join()
+
+  def run(self):
+    """write batches until stopped."""
+    running = True
+    while running:
+      batch = [self.queue.get()]
+      while len(batch) < _TRACE_BATCH_SIZE:
+        try:
+          batch.append(self.queue.get_nowait())
+        except queue.Empty:
+          break
+      if None in batch:
+        running = False
+        batch = [x for x in batch if x is not None]
+      self._write(batch)
+
+  def _write(self, batch):
+    """format and write a batch (rotation happens here, off-request)."""
+    dropped = self.dropped
+    if dropped != self._reported:
+      batch.append((time.time(),
+                    "TRACE",
+                    _new_id(),
+                    ( ('Dropped', dropped - self._reported),
+                      ('Written', self.written), )))
+      self._reported = dropped
+    for item in batch:
+      created = item[0]
+      if _LOG_FORMAT == _LOG_JSON:
+        msg = json.dumps({"ts": created,
+                          "stage": item[1],
+                          "id": item[2],
+                          "data": item[3]}, default=str)
+      else:
+        msg = "{0}:{1} -> {2}".format(item[1], item[2], item[3])
+      record = logging.makeLogRecord({"name": self.target.name,
+                                      "levelno": logging.INFO,
+                                      "levelname": "INFO",
+                                      "msg": msg,
+                                      "created": created,
+                                      "msecs": (created % 1) * 1000})
+      try:
+        self.target.handle(record)
+      except Exception:
+        pass
+    self.written = self.written + len(batch)
+    self.batches = self.batches + 1
+
+
+def _stop_writer():
+  """flush and stop trace writing."""
+  global _writer
+  writer = _writer
+  _writer = None
+  if writer is not None:
+    writer.stop()
+
+
+def _seen_request(user, macs, accepted, p):
+  """update the last seen table from a post_auth decision."""
+  nas = None
+  port = None
+  for item in p:
+    if item[0] == "NAS-IP-Address" or \
+       (item[0] == "NAS-Identifier" and nas is None):
+      nas = item[1]
+    elif item[0] == "NAS-Port":
+      port = item[1]
+  now = time.time()
+  flush = False
+  with _seen_lock:
+    for mac in macs:
+      key = (user, mac)
+      last = _seen.get(key, (None, None, None, None))
+      if accepted:
+        _seen[key] = (now, last[1], nas, port)
+      else:
+        _seen[key] = (last[0], now, nas, port)
+      _seen_dirty.add(key)
+    flush = len(_seen_dirty) >= _SEEN_BATCH
+  flusher = _flusher
+  if flush and flusher is not None:
+    flusher.wake.set()
+
+
+class _SeenFlusher(threading.Thread):
+  """writes changed last seen rows to sqlite in batches."""
+  def __init__(self, path):
+    threading.Thread.__init__(self, name="freepydius-seen")
+    self.daemon = True
+    self.path = path
+    self.wake = threading.Event()
+    self.stopping = False
+    self.flushes = 0
+
+  def stop(self):
+    """flush anything pending and stop the thread."""
+    self.stopping = True
+    self.wake.set()
+    self.join()
+
+  def run(self):
+    """flush every _SEEN_FLUSH seconds (or a full batch) until stopped."""
+    try:
+      conn = sqlite3.connect(self.path)
+      conn.execute("PRAGMA journal_mode=WAL")
+      conn.execute(_SEEN_SCHEMA)
+      self._load(conn)
+    except sqlite3.Error as e:
+      Log("SEEN").log(( ('Error', str(e)), ))
+      return
+    try:
+      while not self.stopping:
+        self.wake.wait(_SEEN_FLUSH)
+        self.wake.clear()
+        self._flush(conn)
+      self._flush(conn)
+    finally:
+      conn.close()
+
+  def _load(self, conn):
+    """fill fields this process has not seen yet from the stored rows."""
+    rows = conn.execute("SELECT user, mac, last_accept, last_reject, "
+                        "nas, port FROM seen").fetchall()
+    with _seen_lock:
+      for row in rows:
+        key = (row[0], row[1])
+        last = _seen.get(key)
+        if last is None:
+          _seen[key] = tuple(row[2:])
+          continue
+        _seen[key] = tuple(last[i] if last[i] is not None else row[2 + i]
+                           for i in range(4))
+        _seen_dirty.add(key)
+
+  def _flush(self, conn):
+    """write the changed rows in one transaction."""
+    global _seen_dirty
+    with _seen_lock:
+      dirty = _seen_dirty
+      _seen_dirty = set()
+      rows = [key + _seen[key] for key in dirty]
+    if len(rows) == 0:
+      return
+    try:
+      with conn:
+        conn.executemany("INSERT OR REPLACE INTO seen "
+                         "VALUES (?, ?, ?, ?, ?, ?)", rows)
+      self.flushes = self.flushes + 1
+    except sqlite3.Error as e:
+      with _seen_lock:
+        _seen_dirty.update(dirty)
+      Log("SEEN").log(( ('Error', str(e)), ))
+
+
+def _stop_seen():
+  """flush and stop last seen writing."""
+  global _flusher
+  flusher = _flusher
+  _flusher = None
+  if flusher is not None:
+    flusher.stop()
+
+
+def _stage_error():
+  """count an exception caught by a stage."""
+  global _stage_errors
+  with _stage_errors_lock:
+    _stage_errors = _stage_errors + 1
+
+
+def _echo(stage):
+  """check if requests for a stage are echoed to stdout."""
+  return _ECHO.get(stage, _ECHO_DEFAULT)
 
 
 def instantiate(p):
-  print("*** instantiate ***")
-  print(p)
+  if _echo("INSTANCE"):
+    print("*** instantiate ***")
+    print(p)
   with rlock:
     global logger
-    logger = logging.getLogger("freepydius-logger")
-    logger.setLevel(logging.INFO)
-    handler = TimedRotatingFileHandler(_LOG_FILE,
-                                       when="midnight",
-                                       interval=1)
-    formatter = logging.Formatter("%(asctime)s %(message)s")
-    handler.setFormatter(formatter)
-    logger.addHandler(handler)
+    global _writer
+    if _writer is None:
+      logger = logging.getLogger("freepydius-logger")
+      logger.setLevel(logging.INFO)
+      handler = TimedRotatingFileHandler(_LOG_FILE,
+                                         when="midnight",
+                                         interval=1)
+      if _LOG_FORMAT == _LOG_JSON:
+        formatter = logging.Formatter("%(message)s")
+      else:
+        formatter = logging.Formatter("%(asctime)s %(message)s")
+      handler.setFormatter(formatter)
+      logger.addHandler(handler)
+      _writer = _TraceWriter(logger)
+      _writer.start()
+      atexit.register(_stop_writer)
+    global _flusher
+    if _flusher is None and _SEEN_FILE is not None:
+      _flusher = _SeenFlusher(_SEEN_FILE)
+      _flusher.start()
+      atexit.register(_stop_seen)
     log = Log("INSTANCE")
     log.log(( ('Response', 'created'), ))
+  try:
+    _current()
+  except Exception as e:
+    log.log("error")
+    log.log(str(e))
   # return 0 for success or -1 for failure
   return 0
 
 
 def authenticate(p):
-  log = Log("AUTHENTICATE")
+  log = Log("AUTHENTICATE", p)
   log.log(p)
   radiusd.radlog(radiusd.L_INFO, '*** radlog call in authenticate ***')
-  print("")
-  print(p)
-  print("")
-  print(radiusd.config)
+  if _echo("AUTHENTICATE"):
+    print("")
+    print(p)
+    print("")
+    print(radiusd.config)
   return radiusd.RLM_MODULE_OK
 
 
@@ -313,16 +1330,19 @@ def checksimul(p):
 
 
 def authorize(p):
-  log = Log("AUTHORIZE")
+  log = Log("AUTHORIZE", p)
   log.log(p)
-  print("*** authorize ***")
-  print("")
+  echo = _echo("AUTHORIZE")
+  if echo:
+    print("*** authorize ***")
+    print("")
   radiusd.radlog(radiusd.L_INFO, '*** radlog call in authorize ***')
-  print("")
-  print(p)
-  print("")
-  print(radiusd.config)
-  print("")
+  if echo:
+    print("")
+    print(p)
+    print("")
+    print(radiusd.config)
+    print("")
   reply = ()
   conf = ()
   try:
@@ -330,16 +1350,13 @@ def authorize(p):
     user = user_mac[0]
     macs = user_mac[1]
     if user is not None:
-      password = _get_pass(user)
-      if password is not None:
-        conf = ( ('Cleartext-Password', password), )
-      if macs is not None:
-        vlan = _get_vlan(user, macs)
-        if vlan is not None:
-          reply = ( ('Tunnel-Type', 'VLAN'),
-                    ('Tunnel-Medium-Type', 'IEEE-802'),
-                    ('Tunnel-Private-Group-Id', vlan), )
+      resolved = _resolve_conversation(p, user)
+      if resolved is not None and resolved.password is not None:
+        conf = ( ('Cleartext-Password', resolved.password), )
+      if _matched(resolved, macs):
+        reply = resolved.reply
   except Exception as e:
+    _stage_error()
     log.log("error")
     log.log(str(e))
   log.log(reply)
@@ -348,47 +1365,57 @@ def authorize(p):
 
 
 def preacct(p):
-  print("*** preacct ***")
-  print(p)
+  if _echo("PREACCT"):
+    print("*** preacct ***")
+    print(p)
   return radiusd.RLM_MODULE_OK
 
 
 def accounting(p):
-  log = Log("ACCOUNTING")
+  log = Log("ACCOUNTING", p)
   log.log(p)
-  print("*** accounting ***")
+  echo = _echo("ACCOUNTING")
+  if echo:
+    print("*** accounting ***")
   radiusd.radlog(radiusd.L_INFO, '*** radlog call in accounting (0) ***')
-  print("")
-  print(p)
+  if echo:
+    print("")
+    print(p)
   return radiusd.RLM_MODULE_OK
 
 
 def pre_proxy(p):
-  print("*** pre_proxy ***")
-  print(p)
+  if _echo("PREPROXY"):
+    print("*** pre_proxy ***")
+    print(p)
   return radiusd.RLM_MODULE_OK
 
 
 def post_proxy(p):
-  print("*** post_proxy ***")
-  print(p)
+  if _echo("POSTPROXY"):
+    print("*** post_proxy ***")
+    print(p)
   return radiusd.RLM_MODULE_OK
 
 
 def post_auth(p):
-  log = Log("POSTAUTH")
+  log = Log("POSTAUTH", p)
   log.log(p)
-  print("*** post_auth ***")
-  print(p)
+  if _echo("POSTAUTH"):
+    print("*** post_auth ***")
+    print(p)
   response = radiusd.RLM_MODULE_REJECT
   try:
     user_mac = _get_user_mac(p)
     user = user_mac[0]
     macs = user_mac[1]
     if user is not None and macs is not None:
-      if _get_vlan(user, macs) is not None:
+      resolved = _resolve_conversation(p, user, credential=False)
+      if _matched(resolved, macs):
         response = radiusd.RLM_MODULE_OK
+      _seen_request(user, macs, response == radiusd.RLM_MODULE_OK, p)
   except Exception as e:
+    _stage_error()
     log.log("error")
     log.log(str(e))
   log.log(( ('Response', response), ))
@@ -396,17 +1423,22 @@ def post_auth(p):
 
 
 def recv_coa(p):
-  print("*** recv_coa ***")
-  print(p)
+  if _echo("RECVCOA"):
+    print("*** recv_coa ***")
+    print(p)
   return radiusd.RLM_MODULE_OK
 
 
 def send_coa(p):
-  print("*** send_coa ***")
-  print(p)
+  if _echo("SENDCOA"):
+    print("*** send_coa ***")
+    print(p)
   return radiusd.RLM_MODULE_OK
 
 
 def detach():
-  print("*** detach ***")
+  if _echo("DETACH"):
+    print("*** detach ***")
+  _stop_seen()
+  _stop_writer()
   return radiusd.RLM_MODULE_OK
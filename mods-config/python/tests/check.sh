@@ -44,6 +44,121 @@ if [ $? -ne 0 ]; then
     exit -1
 fi
 
+test-config "AABBCCDDEE11" "aabbccddee11" "network.json" > $OUT
+test-config-full "AABBCCDDEE11" "aabbccddee11" "network.json" "/nonexistent" | diff $OUT -
+if [ $? -ne 0 ]; then
+    echo "mac bypass needs a keyfile..."
+    exit -1
+fi
+
+BATCH_OUT="actual_batch.log"
+python ../utils/harness.py --batch batch.jsonl --json network.json --keyfile keyfile.test | sed 's/"elapsed_ms": [0-9.e-]*, //' > $BATCH_OUT
+diff expected_batch.log $BATCH_OUT
+if [ $? -ne 0 ]; then
+    echo "different batch results..."
+    exit -1
+fi
+
+REPORT_OUT="actual_report.log"
+REPORT_LOGS=$(mktemp -d)
+TRACE_LOG=$REPORT_LOGS/trace.log.$(date -d yesterday +%F)
+for ext in $(echo "plain gz zst"); do
+    cp trace.log $TRACE_LOG
+    case $ext in
+        gz) gzip $TRACE_LOG ;;
+        zst)
+            python -c "import zstandard" 2>/dev/null && which zstd > /dev/null
+            if [ $? -ne 0 ]; then
+                continue
+            fi
+            zstd -q --rm $TRACE_LOG ;;
+    esac
+    python ../utils/report_auths.py --config network.json --logs $REPORT_LOGS --days 1 | sed 's/[0-9]\{4\}-[0-9]\{2\}-[0-9]\{2\}/DATE/' > $REPORT_OUT
+    rm -f $REPORT_LOGS/*
+    diff expected_report.log $REPORT_OUT
+    if [ $? -ne 0 ]; then
+        echo "different report ($ext) results..."
+        rm -rf $REPORT_LOGS
+        exit -1
+    fi
+done
+rm -rf $REPORT_LOGS
+
+# post_auth keeps a last seen table (every login of the trace is replayed
+# through it), the table has no accept-without-response (?) marker
+SEEN_DB="actual_seen.db"
+rm -f $SEEN_DB
+python -c "
+import sys
+sys.path.insert(0, '../utils')
+import wrapper
+import tracelog
+mod = wrapper.freepydius
+mod._CONFIG_FILE = 'network.json'
+mod._ENC_KEY_FILE = 'keyfile.test'
+mod._LOG_FILE = 'actual_trace.log'
+mod._SEEN_FILE = '$SEEN_DB'
+mod._ECHO_DEFAULT = False
+wrapper.radiusd.config = ()
+mod.instantiate(())
+for record in tracelog.read('trace.log'):
+    if tracelog.is_request(record):
+        mod.post_auth(tracelog.pairs(record))
+mod.detach()"
+python ../utils/report_auths.py --config network.json --seen $SEEN_DB --days 1 | sed 's/[0-9]\{4\}-[0-9]\{2\}-[0-9]\{2\}/DATE/' > $REPORT_OUT
+sed 's/?//' expected_report.log | diff - $REPORT_OUT
+if [ $? -ne 0 ]; then
+    echo "different last seen report results..."
+    exit -1
+fi
+
+# connections whose notification fails are removed so the next run retries
+CONNECTS_DB="actual_auths.db"
+rm -f $CONNECTS_DB
+python -c "
+import sys
+import sqlite3
+sys.path.insert(0, '../utils')
+import connects
+import notify
+attempts = []
+sent = []
+
+
+def failing(text):
+    attempts.append(text)
+    raise Exception('unavailable')
+
+
+def _run(sender):
+    conn = sqlite3.connect('$CONNECTS_DB')
+    notifier = notify.Digest(sender=sender, retries=1, backoff=0)
+    connects._prepare(conn)
+    with open('trace.log') as f:
+        connects._report(conn, connects._tracked(f), notifier)
+    rows = conn.execute('SELECT COUNT(*) FROM tracked').fetchone()[0]
+    conn.close()
+    return notifier, rows
+
+
+notifier, rows = _run(failing)
+failed = sorted(notifier.failed)
+if len(attempts) != 2 or len(failed) == 0 or rows != 0:
+    sys.exit('failed digest (attempts {}, rows {})'.format(len(attempts), rows))
+notifier, rows = _run(sent.append)
+if len(sent) != 1 or notifier.failed or rows != len(failed):
+    sys.exit('failed connections not reported again')
+for t in failed:
+    if str(t) not in sent[0]:
+        sys.exit('not reported again: {}'.format(t))
+notifier, rows = _run(sent.append)
+if len(sent) != 1 or rows != len(failed):
+    sys.exit('connections reported twice')" > /dev/null
+if [ $? -ne 0 ]; then
+    echo "connection notifications are not retried..."
+    exit -1
+fi
+
 for f in $(echo "b c u v"); do
     rm -f ${USRS}$f*
 done
@@ -56,6 +171,17 @@ if [ $? -ne 0 ]; then
     exit -1
 fi
 
+CACHE="actual.cache"
+rm -f $CACHE
+for run in $(echo "cold warm"); do
+    python ../utils/config_compose.py --output $OUT_JSON --audit $AUDIT_CSV --cache $CACHE > /dev/null
+    diff expected.json $OUT_JSON
+    if [ $? -ne 0 ]; then
+        echo "different cached ($run) composed results..."
+        exit -1
+    fi
+done
+
 cat $AUDIT_CSV | sort > $AUDIT_CSV_SORT
 diff audit_exp.csv $AUDIT_CSV_SORT
 if [ $? -ne 0 ]; then
@@ -63,6 +189,74 @@ if [ $? -ne 0 ]; then
     exit -1
 fi
 
+rm -f ${USRS}user_* ${USRS}vlan_*
+cp declared/*.jsonl $USRS
+python ../utils/config_compose.py --output $OUT_JSON --audit $AUDIT_CSV > /dev/null
+rm -f ${USRS}*.jsonl
+diff expected.json $OUT_JSON
+if [ $? -ne 0 ]; then
+    echo "different declarative composed results..."
+    exit -1
+fi
+cat $AUDIT_CSV | sort | diff audit_exp.csv -
+if [ $? -ne 0 ]; then
+    echo "different declarative audit results..."
+    exit -1
+fi
+
+# wildcards are mac fragments of at least an OUI (6 hex digits)
+rm -f ${USRS}user_* ${USRS}vlan_*
+cp vlan_test.py user_user3.py $USRS
+sed -i 's/\["aabbcc"\]/["abc"]/' ${USRS}user_user3.py
+python ../utils/config_compose.py --output $OUT_JSON --audit $AUDIT_CSV | grep -q "invalid wildcard detected abc"
+if [ $? -ne 0 ]; then
+    echo "short wildcard composed..."
+    exit -1
+fi
+python -c "
+import sys
+sys.path.insert(0, '../utils')
+import wrapper
+tables = wrapper.freepydius._mac_auth_tables({'dev.user': {'wildcard': ['a', 'abc', 'zzzzzz', 'AA:BB:CC']}})
+sys.exit(0 if tables[1] == {'aabbcc': 'dev'} else 1)"
+if [ $? -ne 0 ]; then
+    echo "short or invalid wildcard honored..."
+    exit -1
+fi
+
+# an inherited object is checked (macs time-disabled) before it is copied
+rm -f ${USRS}user_* ${USRS}vlan_*
+cp vlan_test.py inherits/*.py $USRS
+INHERITS_JSON="actual_inherits.json"
+python ../utils/config_compose.py --output $INHERITS_JSON --audit $AUDIT_CSV > /dev/null
+grep -q "001122334466" $INHERITS_JSON
+if [ $? -eq 0 ]; then
+    echo "inherited a time-disabled mac..."
+    exit -1
+fi
+python -c "
+import sys
+sys.path.insert(0, '../utils')
+import config_compose
+config_compose._CHUNK = 1
+config_compose._process('$OUT_JSON', '$AUDIT_CSV', workers=2)" > /dev/null
+diff $INHERITS_JSON $OUT_JSON
+if [ $? -ne 0 ]; then
+    echo "different parallel inherited results..."
+    exit -1
+fi
+rm -f $CACHE
+for run in $(echo "cold warm"); do
+    python ../utils/config_compose.py --output $OUT_JSON --audit $AUDIT_CSV --cache $CACHE > /dev/null
+    diff $INHERITS_JSON $OUT_JSON
+    if [ $? -ne 0 ]; then
+        echo "different cached ($run) inherited results..."
+        exit -1
+    fi
+    # only the inheriting file changes
+    echo "# touched" >> ${USRS}user_heir.py
+done
+
 test-config-full "dev.pwd" $valid_mac "expected.json" "keyfile.pad" > $KEY_LOG
 diff expect_key.log $KEY_LOG
 if [ $? -ne 0 ]; then
@@ -88,3 +282,9 @@ if [ $? -ne 0 ]; then
     echo "different keying results..."
     exit -1
 fi
+
+./scale.sh
+if [ $? -ne 0 ]; then
+    echo "parallel composition differs from serial..."
+    exit -1
+fi
@@ -0,0 +1,7 @@
+"""User inheriting from another file (after its checks ran)."""
+import users.__config__ as __config__
+import users.user_base as base
+admin = __config__.Assignment()
+admin.inherits = base.normal
+admin.vlan = "prod"
+admin.group = 'admin'
@@ -0,0 +1,69 @@
+#!/bin/bash
+# opt-in performance checks (not run by check.sh, timings vary on shared
+# hosts): composition must stay linear and, on multi-cpu hosts, a pool must
+# speed up composing real definition files
+SCALE_USERS=${SCALE_USERS:-100000} SCALE_SECONDS=${SCALE_SECONDS:-30} ./scale.sh
+if [ $? -ne 0 ]; then
+    echo "composition does not scale..."
+    exit -1
+fi
+OUT=$(mktemp -d)
+RESULT=0
+CPUS=${SCALE_CPUS:-$(nproc)}
+if [ $CPUS -lt 2 ]; then
+    echo "parallel speedup not checked (1 cpu)" >&2
+else
+    # a pool must beat a serial run importing real definition files
+    mkdir $OUT/tree
+    cp -r ../freepydius.py ../radiusd.py ../utils $OUT/tree/
+    rm -f $OUT/tree/utils/users/user_* $OUT/tree/utils/users/vlan_*
+    python - ${SCALE_FILES:-5000} $CPUS $OUT/tree/utils <<'PYTHON'
+import sys
+import os
+import subprocess
+import time
+
+count = int(sys.argv[1])
+cpus = int(sys.argv[2])
+utils = sys.argv[3]
+folder = os.path.join(utils, "users")
+with open(os.path.join(folder, "vlan_scale.py"), 'w') as f:
+    f.write("import users.__config__ as __config__\n"
+            "scale = __config__.VLAN(\"scale\", 10)\n")
+for idx in range(count):
+    with open(os.path.join(folder, "user_u{}.py".format(idx)), 'w') as f:
+        f.write("import users.__config__ as __config__\n"
+                "u{0} = __config__.Assignment()\n"
+                "u{0}.vlan = \"scale\"\n"
+                "u{0}.group = \"scale\"\n"
+                "u{0}.password = \"{0:032d}\"\n"
+                "u{0}.macs = [\"{1:012x}\", \"{2:012x}\"]\n".format(
+                    idx, idx * 2, idx * 2 + 1))
+
+
+def _compose(workers):
+    started = time.time()
+    with open(os.devnull, 'w') as devnull:
+        subprocess.check_call(["python",
+                               "config_compose.py",
+                               "--output", "scale.json",
+                               "--audit", "scale.csv",
+                               "--workers", str(workers)],
+                              cwd=utils,
+                              stdout=devnull)
+    elapsed = time.time() - started
+    sys.stderr.write("composed {} files in {:.2f}s ({} workers)\n".format(
+        count, elapsed, workers))
+    return elapsed
+
+
+serial = _compose(1)
+parallel = _compose(cpus)
+if parallel >= serial:
+    sys.stderr.write("parallel composition is not faster than serial\n")
+    exit(1)
+PYTHON
+    RESULT=$?
+fi
+rm -rf $OUT
+exit $RESULT
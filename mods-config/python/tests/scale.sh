@@ -0,0 +1,77 @@
+#!/bin/bash
+# compose a large (synthetic) set of users, a pool must match a serial run
+# (timings are only asserted when a limit is given, see perf.sh)
+USERS=${SCALE_USERS:-10000}
+LIMIT=${SCALE_SECONDS:-0}
+OUT=$(mktemp -d)
+cd ../utils/
+python - $USERS $LIMIT $OUT <<'PYTHON' > $OUT/compose.log
+import sys
+import os
+import time
+import config_compose
+import users.__config__ as config
+
+count = int(sys.argv[1])
+limit = float(sys.argv[2])
+out = sys.argv[3]
+vlans = 4
+
+
+def _vlan(idx):
+    obj = config.VLAN("vlan{}".format(idx), 10 + idx)
+    return obj
+
+
+def _user(idx):
+    obj = config.Assignment()
+    obj.vlan = "vlan{}".format(idx % vlans)
+    obj.group = "scale"
+    obj.password = "{:032d}".format(idx)
+    obj.macs = ["{:012x}".format(idx * 2), "{:012x}".format(idx * 2 + 1)]
+    if idx % 10 == 0:
+        obj.bypass = ["f{:011x}".format(idx)]
+    return obj
+
+
+def _by_indicator(indicator):
+    if indicator == config_compose.VLAN_INDICATOR:
+        return ["vlan_{}".format(x) for x in range(vlans)]
+    return ["user_u{}".format(x) for x in range(count)]
+
+
+def _load_objs(name, typed):
+    idx = int(name.split("_")[1].lstrip("u"))
+    if typed == config.VLAN:
+        yield _vlan(idx)
+    else:
+        yield _user(idx)
+
+
+def _compose(workers):
+    started = time.time()
+    results = [os.path.join(out, "scale{}.{}".format(workers, x))
+               for x in ["json", "csv"]]
+    config_compose._process(results[0], results[1], workers=workers)
+    elapsed = time.time() - started
+    sys.stderr.write("composed {} users in {:.2f}s ({} workers)\n".format(
+        count, elapsed, workers))
+    if limit > 0 and elapsed > limit:
+        sys.stderr.write("composition too slow (limit {}s)\n".format(limit))
+        exit(1)
+    composed = []
+    for result in results:
+        with open(result, 'r') as f:
+            composed.append(f.read())
+    return composed
+
+
+config_compose._get_by_indicator = _by_indicator
+config_compose._load_objs = _load_objs
+if _compose(1) != _compose(4):
+    sys.stderr.write("parallel composition differs from serial\n")
+    exit(1)
+PYTHON
+RESULT=$?
+rm -rf $OUT
+exit $RESULT
@@ -0,0 +1,225 @@
+#!/usr/bin/python
+"""Microbenchmarks for freepydius hot functions with stored baselines."""
+import argparse
+import json
+import math
+import os
+import platform
+import shutil
+import tempfile
+import timeit
+import wrapper
+import synth
+
+SIZES = "10,1000,100000"
+REPEAT = 7
+NUMBER = 1000
+THRESHOLD = 0.10
+ALPHA = 0.01
+MIN_REPEAT = 5
+_ANY = "-"
+
+
+def _median(samples):
+    """Median of the samples."""
+    ordered = sorted(samples)
+    mid = len(ordered) // 2
+    if len(ordered) % 2 == 1:
+        return ordered[mid]
+    return (ordered[mid - 1] + ordered[mid]) / 2.0
+
+
+def _counts(m, n):
+    """Count of orderings of m and n samples by Mann-Whitney U value."""
+    table = {}
+    for i in range(m + 1):
+        for j in range(n + 1):
+            if i == 0 or j == 0:
+                table[(i, j)] = [1]
+                continue
+            counts = [0] * (i * j + 1)
+            for u, count in enumerate(table[(i - 1, j)]):
+                counts[u + j] += count
+            for u, count in enumerate(table[(i, j - 1)]):
+                counts[u] += count
+            table[(i, j)] = counts
+    return table[(m, n)]
+
+
+def _mann_whitney(base, current):
+    """Get the one-sided p value of current being slower (rank test).
+
+    Exact for small samples without ties, else the normal approximation.
+    """
+    m = len(current)
+    n = len(base)
+    u = 0.0
+    for c in current:
+        for b in base:
+            if c > b:
+                u += 1
+            elif c == b:
+                u += 0.5
+    if m * n <= 400 and len(set(base) | set(current)) == m + n:
+        counts = _counts(m, n)
+        return float(sum(counts[int(u):])) / sum(counts)
+    mean = m * n / 2.0
+    dev = math.sqrt(m * n * (m + n + 1) / 12.0)
+    z = (u - 0.5 - mean) / dev
+    return 0.5 * math.erfc(z / math.sqrt(2))
+
+
+def _measure(call, repeat, number):
+    """Per-call seconds for each repeat."""
+    timer = timeit.Timer(call)
+    return [x / number for x in timer.repeat(repeat, number)]
+
+
+def _fixed(mod, key):
+    """Get the benchmarks that do not depend on the config size."""
+    encrypted = mod._encrypt(synth.KEY_CHARS[:synth.PASSWORD_LENGTH], key)
+    plain = synth.KEY_CHARS[:synth.PASSWORD_LENGTH]
+    p = (("User-Name", "DOMAIN\\vlan0.user0"),
+         ("Calling-Station-Id", "00-11-22-33-44-55"),
+         ("NAS-IP-Address", "10.0.0.1"))
+    log = mod.Log("BENCH")
+    return [("_convert_user_name",
+             lambda: mod._convert_user_name("DOMAIN\\vlan0.user0")),
+            ("_mac", lambda: mod._mac("0011223344ff")),
+            ("_convert_mac", lambda: mod._convert_mac("00:11:22:33:44:FF")),
+            ("_get_user_mac", lambda: mod._get_user_mac(p)),
+            ("_pad", lambda: mod._pad(2, 1234567890)),
+            ("_encrypt", lambda: mod._encrypt(plain, key)),
+            ("_decrypt", lambda: mod._decrypt(encrypted, key)),
+            ("Log.log", lambda: log.log(p))]
+
+
+def _sized(mod, population, config):
+    """Get the benchmarks over a generated config."""
+    user, mac = population.logins[len(population.logins) // 2]
+    signature = mod._signature(config)
+    return [("_load_snapshot",
+             lambda: mod._load_snapshot(config, signature, 1)),
+            ("_config", lambda: mod._config(user)),
+            ("_get_pass", lambda: mod._get_pass(user)),
+            ("_get_vlan", lambda: mod._get_vlan(user, [mac]))]
+
+
+def run(sizes, repeat, number, macs, only):
+    """Run all benchmarks, returns {name@size: samples}."""
+    mod = wrapper.freepydius
+    results = {}
+    folder = tempfile.mkdtemp()
+    try:
+        mod._LOG_FILE = os.path.join(folder, wrapper.LOG_FILE)
+        mod._SEEN_FILE = os.path.join(folder, wrapper.SEEN_FILE)
+        mod._ECHO_DEFAULT = False
+        mod.instantiate(())
+        key = None
+        for size in sizes:
+            users = max(1, size // macs)
+            population = synth.generate(users=users, macs=macs)
+            config, keyfile = population.write(folder)
+            mod._CONFIG_FILE = config
+            mod._ENC_KEY_FILE = keyfile
+            key = mod._get_tea_key()
+            mod._current()
+            for name, call in _sized(mod, population, config):
+                if only and name not in only:
+                    continue
+                count = number
+                if name == "_load_snapshot":
+                    count = 1
+                print("{}@{}...".format(name, size))
+                results["{}@{}".format(name, size)] = _measure(call,
+                                                               repeat,
+                                                               count)
+        for name, call in _fixed(mod, key):
+            if only and name not in only:
+                continue
+            print("{}...".format(name))
+            results["{}@{}".format(name, _ANY)] = _measure(call,
+                                                           repeat,
+                                                           number)
+        mod.detach()
+    finally:
+        shutil.rmtree(folder)
+    return results
+
+
+def compare(baseline, results, threshold):
+    """Compare against a baseline, returns the regressed names."""
+    regressed = []
+    print("| benchmark | baseline (us) | current (us) | change | p |")
+    print("| ---       | ---           | ---          | ---    | --- |")
+    for name in sorted(results.keys()):
+        if name not in baseline:
+            continue
+        base = baseline[name]
+        current = results[name]
+        b_median = _median(base)
+        c_median = _median(current)
+        # best of repeats is least disturbed by noise, medians are reported
+        change = (min(current) - min(base)) / min(base)
+        p = _mann_whitney(base, current)
+        flag = ""
+        if change > threshold and p < ALPHA:
+            flag = " **slower**"
+            regressed.append(name)
+        row = "| {} | {:.2f} | {:.2f} | {:+.1%}{} | {:.3f} |"
+        print(row.format(name, b_median * 1e6, c_median * 1e6, change, flag,
+                         p))
+    return regressed
+
+
+def main():
+    """Main entry."""
+    parser = argparse.ArgumentParser(description="freepydius benchmarks")
+    parser.add_argument("--sizes", type=str, default=SIZES,
+                        help="comma separated config sizes (macs)")
+    parser.add_argument("--macs", type=int, default=2,
+                        help="macs per generated user")
+    parser.add_argument("--repeat", type=int, default=REPEAT)
+    parser.add_argument("--number", type=int, default=NUMBER)
+    parser.add_argument("--only", type=str, default=None,
+                        help="comma separated benchmark names")
+    parser.add_argument("--baseline", type=str, default="bench.json")
+    parser.add_argument("--save", action="store_true",
+                        help="store results as the baseline")
+    parser.add_argument("--threshold", type=float, default=THRESHOLD,
+                        help="relative slowdown to flag")
+    args = parser.parse_args()
+    if args.repeat < MIN_REPEAT:
+        print("at least {} repeats are needed".format(MIN_REPEAT))
+        exit(1)
+    sizes = [int(x) for x in args.sizes.split(",")]
+    only = None
+    if args.only:
+        only = args.only.split(",")
+    results = run(sizes, args.repeat, args.number, args.macs, only)
+    if args.save:
+        with open(args.baseline, 'w') as f:
+            f.write(json.dumps({"python": platform.python_version(),
+                                "results": results},
+                               sort_keys=True,
+                               indent=4))
+        print("baseline saved: " + args.baseline)
+        return
+    if not os.path.exists(args.baseline):
+        print("no baseline (run with --save first)")
+        exit(1)
+    with open(args.baseline, 'r') as f:
+        baseline = json.loads(f.read())["results"]
+    short = [x for x in baseline if len(baseline[x]) < MIN_REPEAT]
+    if len(short) > 0:
+        print("baseline has fewer than {} repeats: {}".format(
+            MIN_REPEAT, ", ".join(sorted(short))))
+        exit(1)
+    regressed = compare(baseline, results, args.threshold)
+    if len(regressed) > 0:
+        print("regressions: " + ", ".join(regressed))
+        exit(1)
+
+
+if __name__ == "__main__":
+    main()
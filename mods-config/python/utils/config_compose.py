@@ -7,12 +7,47 @@ import users
 import users.__config__
 import wrapper
 import importlib
+import collections
 import csv
+import datetime
+import hashlib
+import re
+import sys
+from multiprocessing import Pool
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
 
 # file indicators
 IND_DELIM = "_"
 USER_INDICATOR = "user" + IND_DELIM
 VLAN_INDICATOR = "vlan" + IND_DELIM
+# declarative (one json object per line) definitions
+DECLARED = ".jsonl"
+# definition files per pool task
+_CHUNK = 64
+_EXIT = "exit"
+_RAISE = "raise"
+_common = None
+_common_loaded = False
+# bump when normalization changes (invalidates composition caches)
+_CACHE_VERSION = 1
+_REFERENCE = re.compile(USER_INDICATOR + r"\w+")
+# a validated assignment, cross-user checks happen when merging
+_User = collections.namedtuple("_User", ["key",
+                                         "vlan",
+                                         "error",
+                                         "disabled",
+                                         "macs",
+                                         "password",
+                                         "inherits",
+                                         "bypass",
+                                         "port_bypass",
+                                         "wildcards",
+                                         "attrs",
+                                         "no_login",
+                                         "audit"])
 
 
 class ConfigMeta(object):
@@ -20,22 +55,24 @@ class ConfigMeta(object):
 
     def __init__(self):
         """init the instance."""
-        self.passwords = []
-        self.macs = []
-        self.bypasses = []
-        self.vlans = []
+        self.passwords = set()
+        self.macs = set()
+        self.bypasses = set()
+        self.vlans = set()
         self.all_vlans = []
         self.user_name = []
         self.vlan_users = []
-        self.attrs = []
-        self.vlan_initiate = []
+        self.attrs = set()
+        self.vlan_initiate = set()
+        self.vlan_numbers = {}
+        self.vlan_names = {}
 
     def password(self, password):
         """password group validation(s)."""
         if password in self.passwords:
             print("password duplicated")
             exit(-1)
-        self.passwords.append(password)
+        self.passwords.add(password)
 
     def bypassed(self, macs):
         """bypass management."""
@@ -43,46 +80,49 @@ class ConfigMeta(object):
             if mac in self.bypasses:
                 print("already bypassed")
                 exit(-1)
-            self.bypasses.append(mac)
+            self.bypasses.add(mac)
 
     def user_macs(self, macs):
         """user+mac combos."""
-        self.macs = self.macs + macs
-        self.macs = list(set(self.macs))
+        self.macs.update(macs)
 
     def attributes(self, attrs):
         """set attributes."""
-        self.attrs = self.attrs + attrs
-        self.attrs = list(set(self.attrs))
+        self.attrs.update(attrs)
+
+    def vlan_number(self, vlan, num):
+        """vlan numbers must be unique."""
+        if num in self.vlan_numbers:
+            print("vlan number defined multiple times...")
+            exit(-1)
+        if vlan in self.vlan_names:
+            del self.vlan_numbers[self.vlan_names[vlan]]
+        self.vlan_numbers[num] = vlan
+        self.vlan_names[vlan] = num
 
     def verify(self):
         """verify meta data."""
-        for mac in self.macs:
-            if mac in self.bypasses:
-                print("mac is globally bypassed: " + mac)
-                exit(-1)
-        for mac in self.bypasses:
-            if mac in self.macs:
-                print("mac is user assigned: " + mac)
-                exit(-1)
-        used_vlans = set(self.vlans + self.vlan_initiate)
-        if len(used_vlans) != len(set(self.all_vlans)):
+        for mac in sorted(self.macs & self.bypasses):
+            print("mac is globally bypassed: " + mac)
+            exit(-1)
+        all_vlans = set(self.all_vlans)
+        used_vlans = self.vlans | self.vlan_initiate
+        if len(used_vlans) != len(all_vlans):
             print("unused vlans detected")
             exit(-1)
-        for ref in used_vlans:
-            if ref not in self.all_vlans:
-                print("reference to unknown vlan: " + ref)
-                exit(-1)
+        for ref in sorted(used_vlans - all_vlans):
+            print("reference to unknown vlan: " + ref)
+            exit(-1)
 
     def vlan_user(self, vlan, user):
         """indicate a vlan was used."""
-        self.vlans.append(vlan)
+        self.vlans.add(vlan)
         self.vlan_users.append(vlan + "." + user)
         self.user_name.append(user)
 
     def vlan_to_vlan(self, vlan_to):
         """VLAN to VLAN mappings."""
-        self.vlan_initiate.append(vlan_to)
+        self.vlan_initiate.add(vlan_to)
 
 
 def _create_obj(macs, password, attrs, port_bypassed, wildcards):
@@ -108,9 +148,64 @@ def _load_objs(name, typed):
         yield obj
 
 
+def _folder():
+    """the user definitions folder."""
+    return os.path.dirname(os.path.abspath(users.__file__))
+
+
 def _get_by_indicator(indicator):
-    """get by a file type indicator."""
-    return [x for x in sorted(users.__all__) if x.startswith(indicator)]
+    """get by a file type indicator (modules and declarative files)."""
+    mods = [x for x in users.__all__ if x.startswith(indicator)]
+    declared = [x for x in os.listdir(_folder())
+                if x.startswith(indicator) and x.endswith(DECLARED)]
+    return sorted(mods + declared)
+
+
+def _declared(name, typed):
+    """stream (name, object) definitions from a declarative (jsonl) file."""
+    defined = {}
+    with open(os.path.join(_folder(), name), 'r') as f:
+        for num, line in enumerate(f, 1):
+            if len(line.strip()) == 0:
+                continue
+            where = "{}:{}: ".format(name, num)
+            try:
+                values = json.loads(line)
+            except ValueError as e:
+                raise Exception(where + str(e))
+            if not isinstance(values, dict) or "name" not in values:
+                raise Exception(where + "name is required")
+            key = values.pop("name")
+            if typed == users.__config__.VLAN:
+                obj = typed(key, values.pop("number", None))
+                fixed = ["name", "num"]
+            else:
+                obj = typed()
+                fixed = ["disabled", "inherits"]
+                inherits = values.pop("inherits", None)
+                if inherits is not None:
+                    if inherits not in defined:
+                        raise Exception(where + "unknown inherits " +
+                                        inherits)
+                    obj.inherits = defined[inherits]
+            for field in sorted(values):
+                if field in fixed or field not in vars(obj):
+                    raise Exception(where + "unknown field " + field)
+                setattr(obj, field, values[field])
+            if typed == users.__config__.Assignment:
+                defined["{}.{}".format(obj.vlan, key)] = obj
+            yield key, obj
+
+
+def _objects(name, typed):
+    """(name, object) definitions of a module or declarative file."""
+    if name.endswith(DECLARED):
+        for item in _declared(name, typed):
+            yield item
+        return
+    key = name.replace(USER_INDICATOR, "")
+    for obj in _load_objs(name, typed):
+        yield key, obj
 
 
 def _common_call(common, method, entity):
@@ -128,13 +223,280 @@ def check_object(obj):
     return obj.check(wrapper)
 
 
-def _process(output, audit):
-    """process the composition of users."""
-    common_mod = None
+def _write_binary(binary, full):
+    """write the binary config (atomically, readers may have it mapped)."""
+    tmp = binary + ".tmp"
+    with open(tmp, 'wb') as f:
+        f.write(wrapper.pack_config(full))
+    os.rename(tmp, binary)
+
+
+def _write_sqlite(database, full):
+    """apply the config to a sqlite database, only changing rows."""
+    changes = wrapper.sync_sqlite(database, full)
+    for table in changes:
+        added, removed = changes[table]
+        print("{}: +{} -{}".format(table, added, removed))
+
+
+def _load_common():
+    """load the common definitions (once per process)."""
+    global _common, _common_loaded
+    if not _common_loaded:
+        _common_loaded = True
+        try:
+            _common = _get_mod("common")
+        except Exception as e:
+            _common = None
+    return _common
+
+
+def _normalize_obj(key, obj, vlan_names):
+    """validate an assignment on its own (no cross-user checks)."""
+    vlan = None
     try:
-        common_mod = _get_mod("common")
-        print("loaded common definitions...")
+        obj = _common_call(_load_common(), 'ready', obj)
+        if not key.isalnum():
+            print("does not meet naming requirements...")
+            exit(-1)
+        if obj.vlan not in vlan_names:
+            raise Exception("no vlan defined for " + key)
+        vlan = obj.vlan
+        if not check_object(obj):
+            print("did not pass check...")
+            exit(-1)
+        if obj.disabled:
+            print("account is disabled or has expired...")
+            return _User(key, vlan, None, True, *([None] * 9))
+        attrs = []
+        if obj.attrs:
+            attrs = sorted(obj.attrs)
+        user_all = []
+        for l in [obj.macs, obj.port_bypass, obj.bypass]:
+            user_all += list(l)
+        return _User(key,
+                     vlan,
+                     None,
+                     False,
+                     sorted(obj.macs),
+                     obj.password,
+                     bool(obj.inherits),
+                     sorted(obj.bypass),
+                     sorted(obj.port_bypass),
+                     sorted(obj.wildcard),
+                     attrs,
+                     bool(obj.no_login),
+                     sorted(set(user_all)))
+    except SystemExit as e:
+        return _User(key, vlan, (_EXIT, e.code), False, *([None] * 9))
     except Exception as e:
+        return _User(key, vlan, (_RAISE, str(e)), False, *([None] * 9))
+
+
+def _normalize(f_name, vlan_names):
+    """load a user definition file into (printed output, user) records."""
+    key = f_name.replace(USER_INDICATOR, "")
+    records = []
+    saved = sys.stdout
+    sys.stdout = StringIO()
+    try:
+        try:
+            for key, obj in _objects(f_name, users.__config__.Assignment):
+                user = _normalize_obj(key, obj, vlan_names)
+                records.append((sys.stdout.getvalue(), user))
+                sys.stdout = StringIO()
+                if user.error is not None:
+                    break
+        except Exception as e:
+            user = _User(key, None, (_RAISE, str(e)), False, *([None] * 9))
+            records.append((sys.stdout.getvalue(), user))
+    finally:
+        sys.stdout = saved
+    return records
+
+
+def _normalize_chunk(job):
+    """normalize a chunk of definition files (pool worker)."""
+    names, vlan_names = job
+    return [(x, _normalize(x, vlan_names)) for x in names]
+
+
+def _file(f_name):
+    """file name of a definition (modules and declarative files)."""
+    if f_name.endswith(DECLARED):
+        return f_name
+    return f_name + ".py"
+
+
+def _components(names):
+    """group definitions by the user_ files they name (either way).
+
+    Definitions may inherit objects of other files, which serially are
+    only copied after the earlier file was checked (mutating them), so a
+    group has to be normalized in one process, in file order.
+    """
+    parents = dict((x, x) for x in names)
+
+    def _root(name):
+        while parents[name] != name:
+            parents[name] = parents[parents[name]]
+            name = parents[name]
+        return name
+
+    folder = _folder()
+    for f_name in names:
+        path = os.path.join(folder, _file(f_name))
+        if not os.path.exists(path):
+            continue
+        with open(path, 'r') as f:
+            text = f.read()
+        for ref in set(_REFERENCE.findall(text)):
+            if ref in parents and ref != f_name:
+                parents[_root(ref)] = _root(f_name)
+    groups = collections.OrderedDict()
+    for f_name in names:
+        groups.setdefault(_root(f_name), []).append(f_name)
+    return list(groups.values())
+
+
+def _normalize_all(names, vlan_names, workers):
+    """(file, records) in file order, file groups spread over a pool."""
+    if workers == 1:
+        for f_name in names:
+            yield f_name, _normalize(f_name, vlan_names)
+        return
+    chunks = [[]]
+    for group in _components(names):
+        if len(chunks[-1]) >= _CHUNK:
+            chunks.append([])
+        chunks[-1] += group
+    if len(chunks) < 2:
+        for item in _normalize_chunk((names, vlan_names)):
+            yield item
+        return
+    jobs = [(x, vlan_names) for x in chunks]
+    order = iter(names)
+    pending = next(order, None)
+    done = {}
+    pool = Pool(workers)
+    try:
+        for chunk in pool.imap(_normalize_chunk, jobs):
+            done.update(chunk)
+            while pending in done:
+                yield pending, done.pop(pending)
+                pending = next(order, None)
+    finally:
+        pool.close()
+        pool.join()
+
+
+class _Cache(object):
+    """normalized records of definition files keyed by content hashes."""
+
+    def __init__(self, path, vlan_names):
+        """load the cache (empty if missing or any dependency changed)."""
+        self.path = path
+        self.folder = _folder()
+        self.names = set(x for x in os.listdir(self.folder)
+                         if x.endswith(".py") or x.endswith(DECLARED))
+        self.hashes = {}
+        deps = hashlib.sha256()
+        for item in [str(_CACHE_VERSION),
+                     str(datetime.date.today()),
+                     ",".join(vlan_names)]:
+            deps.update(item.encode("utf-8"))
+        for name in sorted(self.names):
+            if not name.startswith(USER_INDICATOR):
+                deps.update(name.encode("utf-8"))
+                deps.update(self._hash(name).encode("utf-8"))
+        self.deps = deps.hexdigest()
+        self.files = {}
+        if os.path.exists(path):
+            try:
+                with open(path, 'r') as f:
+                    stored = json.loads(f.read())
+                if stored["deps"] == self.deps:
+                    self.files = stored["files"]
+            except (ValueError, KeyError):
+                pass
+
+    def _hash(self, name):
+        """content hash of a file in the definitions folder."""
+        if name not in self.hashes:
+            with open(os.path.join(self.folder, name), 'rb') as f:
+                self.hashes[name] = hashlib.sha256(f.read()).hexdigest()
+        return self.hashes[name]
+
+    def key(self, group):
+        """hash of a group of definitions naming each other (see _components).
+
+        A change anywhere in the group reloads all of it, in file order.
+        """
+        key = hashlib.sha256()
+        for f_name in group:
+            key.update(f_name.encode("utf-8"))
+            key.update(self._hash(_file(f_name)).encode("utf-8"))
+        return key.hexdigest()
+
+    def get(self, f_name, key):
+        """cached records (None on a miss)."""
+        cached = self.files.get(f_name)
+        if cached is None or cached[0] != key:
+            return None
+        records = []
+        for printed, fields in cached[1]:
+            user = _User(*fields)
+            if user.error is not None:
+                user = user._replace(error=tuple(user.error))
+            records.append((printed, user))
+        return records
+
+    def put(self, f_name, key, records):
+        """cache a file's records."""
+        self.files[f_name] = [key, [[x[0], list(x[1])] for x in records]]
+
+    def save(self, names):
+        """write the cache (only the given definitions)."""
+        files = dict((x, self.files[x]) for x in names if x in self.files)
+        tmp = self.path + ".tmp"
+        with open(tmp, 'w') as f:
+            f.write(json.dumps({"deps": self.deps, "files": files}))
+        os.rename(tmp, self.path)
+
+
+def _normalized(names, vlan_names, workers, cache=None):
+    """(file, records) in file order, only changed file groups are reloaded."""
+    if cache is None:
+        for item in _normalize_all(names, vlan_names, workers):
+            yield item
+        return
+    c = _Cache(cache, vlan_names)
+    keys = {}
+    missed = set()
+    for group in _components(names):
+        key = c.key(group)
+        for f_name in group:
+            keys[f_name] = key
+        if any(c.get(x, key) is None for x in group):
+            missed.update(group)
+    misses = [x for x in names if x in missed]
+    for f_name, records in _normalize_all(misses, vlan_names, workers):
+        c.put(f_name, keys[f_name], records)
+    c.save(names)
+    for f_name in names:
+        yield f_name, c.get(f_name, keys[f_name])
+
+
+def _process(output,
+             audit,
+             binary=None,
+             database=None,
+             workers=1,
+             cache=None):
+    """process the composition of users."""
+    if _load_common() is not None:
+        print("loaded common definitions...")
+    else:
         print("defaults only...")
     user_objs = {}
     vlans = None
@@ -142,16 +504,13 @@ def _process(output, audit):
     meta = ConfigMeta()
     for v_name in _get_by_indicator(VLAN_INDICATOR):
         print("loading vlan..." + v_name)
-        for obj in _load_objs(v_name, users.__config__.VLAN):
+        for name, obj in _objects(v_name, users.__config__.VLAN):
             if vlans is None:
                 vlans = {}
             if not check_object(obj):
                 exit(-1)
             num_str = str(obj.num)
-            for vk in vlans.keys():
-                if num_str == vlans[vk]:
-                    print("vlan number defined multiple times...")
-                    exit(-1)
+            meta.vlan_number(obj.name, num_str)
             vlans[obj.name] = num_str
             if obj.initiate is not None and len(obj.initiate) > 0:
                 for init_to in obj.initiate:
@@ -161,61 +520,47 @@ def _process(output, audit):
     meta.all_vlans = vlans.keys()
     vlans_with_users = {}
     user_macs = {}
-    for f_name in _get_by_indicator(USER_INDICATOR):
+    names = _get_by_indicator(USER_INDICATOR)
+    normalized = _normalized(names, sorted(vlans), workers, cache=cache)
+    for f_name, records in normalized:
         print("composing..." + f_name)
-        for obj in _load_objs(f_name, users.__config__.Assignment):
-            obj = _common_call(common_mod, 'ready', obj)
-            key = f_name.replace(USER_INDICATOR, "")
-            if not key.isalnum():
-                print("does not meet naming requirements...")
-                exit(-1)
-            vlan = obj.vlan
-            if vlan not in vlans:
-                raise Exception("no vlan defined for " + key)
-            vlans_with_users[vlan] = vlans[vlan]
-            meta.vlan_user(vlan, key)
-            fqdn = vlan + "." + key
-            if not check_object(obj):
-                print("did not pass check...")
-                exit(-1)
-            if obj.disabled:
-                print("account is disabled or has expired...")
+        for printed, user in records:
+            sys.stdout.write(printed)
+            key = user.key
+            vlan = user.vlan
+            if vlan is not None:
+                vlans_with_users[vlan] = vlans[vlan]
+                meta.vlan_user(vlan, key)
+            if user.error is not None:
+                if user.error[0] == _EXIT:
+                    exit(user.error[1])
+                raise Exception(user.error[1])
+            if user.disabled:
                 continue
-            macs = sorted(obj.macs)
-            password = obj.password
-            bypass = sorted(obj.bypass)
-            port_bypassed = sorted(obj.port_bypass)
-            wildcards = sorted(obj.wildcard)
-            attrs = []
-            if obj.attrs:
-                attrs = sorted(obj.attrs)
-                meta.attributes(attrs)
+            fqdn = vlan + "." + key
             # meta checks
-            meta.user_macs(macs)
-            if not obj.inherits:
-                meta.password(password)
-            meta.bypassed(bypass)
+            if user.attrs:
+                meta.attributes(user.attrs)
+            meta.user_macs(user.macs)
+            if not user.inherits:
+                meta.password(user.password)
+            meta.bypassed(user.bypass)
             if fqdn in user_objs:
                 raise Exception(fqdn + " previously defined")
             # use config definitions here
-            if not obj.no_login:
-                user_objs[fqdn] = _create_obj(macs,
-                                              password,
-                                              attrs,
-                                              port_bypassed,
-                                              wildcards)
-            if bypass is not None and len(bypass) > 0:
-                for mac_bypass in bypass:
-                    if mac_bypass in bypass_objs:
-
-                        raise Exception(mac_bypass + " previously defined")
-                    bypass_objs[mac_bypass] = vlan
-            user_all = []
-            for l in [obj.macs, obj.port_bypass, obj.bypass]:
-                user_all += list(l)
+            if not user.no_login:
+                user_objs[fqdn] = _create_obj(user.macs,
+                                              user.password,
+                                              user.attrs,
+                                              user.port_bypass,
+                                              user.wildcards)
+            for mac_bypass in user.bypass:
+                if mac_bypass in bypass_objs:
+                    raise Exception(mac_bypass + " previously defined")
+                bypass_objs[mac_bypass] = vlan
             if key not in user_macs:
                 user_macs[key] = []
-            user_macs[key].append((vlan, sorted(set(user_all))))
+            user_macs[key].append((vlan, user.audit))
     meta.verify()
     full = {}
     full[wrapper.freepydius.USER_KEY] = user_objs
@@ -224,6 +569,10 @@ def _process(output, audit):
     with open(output, 'w') as f:
         f.write(json.dumps(full, sort_keys=True,
                            indent=4, separators=[",", ": "]))
+    if binary is not None:
+        _write_binary(binary, full)
+    if database is not None:
+        _write_sqlite(database, full)
     with open(audit, 'w') as f:
         csv_writer = csv.writer(f, lineterminator=os.linesep)
         for u in user_macs:
@@ -241,8 +590,21 @@ def main():
         parser = argparse.ArgumentParser()
         parser.add_argument("--output", type=str, required=True)
         parser.add_argument("--audit", type=str, required=True)
+        parser.add_argument("--binary", type=str, default=None)
+        parser.add_argument("--sqlite", type=str, default=None)
+        parser.add_argument("--workers", type=int, default=1,
+                            help="processes loading/checking user "
+                                 "definitions (default 1, serial)")
+        parser.add_argument("--cache", type=str, default=None,
+                            help="cache of checked definitions, only "
+                                 "changed files are loaded")
         args = parser.parse_args()
-        _process(args.output, args.audit)
+        _process(args.output,
+                 args.audit,
+                 binary=args.binary,
+                 database=args.sqlite,
+                 workers=args.workers,
+                 cache=args.cache)
         success = True
     except Exception as e:
         print('unable to compose')
@@ -5,9 +5,9 @@ import os
 import sqlite3 as sl
 import sys
 import datetime
-from ast import literal_eval as make_tuple
 import wrapper
-import smirc
+import tracelog
+import notify
 
 
 def _object(user, port, nas_ip, mac):
@@ -15,17 +15,14 @@ def _object(user, port, nas_ip, mac):
     return (user, port, nas_ip, wrapper.convert_mac(mac))
 
 
-def _get(key, existing, tple):
-    """Get a tuple key if not set."""
-    if existing:
-        return existing
-    if tple[0] == key:
-        return tple[1]
+_COLUMNS = "IFNULL(user, ''), IFNULL(port, ''), IFNULL(ip, ''), mac"
+_INDEX = "tracked_connection"
 
 
-def _report(conn, tracked):
-    """Report on new entries as found."""
+def _prepare(conn):
+    """Create the table and its unique index (deduplicating once)."""
     curs = conn.cursor()
+    curs.execute("PRAGMA journal_mode=WAL")
     curs.execute("""
 CREATE TABLE IF NOT EXISTS tracked
 (
@@ -36,51 +33,86 @@ CREATE TABLE IF NOT EXISTS tracked
     mac text
 )
 """)
+    curs.execute("SELECT name FROM sqlite_master "
+                 "WHERE type = 'index' AND name = ?", (_INDEX,))
+    if curs.fetchone() is None:
+        curs.execute("""
+DELETE FROM tracked WHERE rowid NOT IN
+(SELECT MIN(rowid) FROM tracked GROUP BY {})
+""".format(_COLUMNS))
+        curs.execute("CREATE UNIQUE INDEX {} ON tracked ({})".format(
+            _INDEX, _COLUMNS))
+    conn.commit()
+
+
+def _report(conn, tracked, notifier):
+    """Insert entries, reporting those that are new, in one transaction."""
+    curs = conn.cursor()
     date = datetime.datetime.now().strftime("%Y-%m-%d")
-    for row in curs.execute("select user, port, ip, mac from tracked"):
-        t = _object(row[0], row[1], row[2], row[3])
-        if t in tracked:
-            tracked.remove(t)
+    seen = set()
     for t in tracked:
-        try:
-            txt = "auth attempt: {}".format(t)
-            smirc.run(arguments=[txt])
-            print(txt)
-            curs.executemany("""
-INSERT INTO tracked (date, user, port, ip, mac) VALUES (?, ?, ?, ?, ?)
-                             """, [(date, t[0], t[1], t[2], t[3]), ])
-        except Exception as e:
-            print("reporting error")
-            print(t)
-            print(e)
+        if t in seen:
+            continue
+        seen.add(t)
+        curs.execute("""
+INSERT OR IGNORE INTO tracked (date, user, port, ip, mac)
+VALUES (?, ?, ?, ?, ?)
+""", (date, t[0], t[1], t[2], t[3]))
+        if curs.rowcount != 1:
+            continue
+        txt = "auth attempt: {}".format(t)
+        notifier.add(t, txt)
+        print(txt)
+    conn.commit()
+    notifier.close()
+    for err in notifier.errors:
+        print("reporting error")
+        print(err)
+    for t in notifier.failed:
+        # retried on the next run
+        print(t)
+        curs.execute("""
+DELETE FROM tracked WHERE IFNULL(user, '') = IFNULL(?, '')
+AND IFNULL(port, '') = IFNULL(?, '') AND IFNULL(ip, '') = IFNULL(?, '')
+AND mac = ? AND date = ?
+""", (t[0], t[1], t[2], t[3], date))
+    conn.commit()
+
+
+def _tracked(lines):
+    """Lazily read (user, port, ip, mac) entries from trace lines."""
+    for t in tracelog.stream(lines):
+        user = tracelog.value(t, "User-Name")
+        nasp = tracelog.value(t, "NAS-Port")
+        nasi = tracelog.value(t, "NAS-IP-Address")
+        macs = set(tracelog.values(t, "Calling-Station-Id"))
+        for mac in macs:
+            yield _object(user, nasp, nasi, mac)
 
 
 def main():
     """Main entry."""
     parser = argparse.ArgumentParser()
     parser.add_argument("--db", default="/var/db")
+    parser.add_argument("--digest-size", type=int, default=50,
+                        help="most connections per notification")
+    parser.add_argument("--digest-wait", type=float, default=30.0,
+                        help="most seconds a connection waits to be sent")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="print notifications instead of sending them")
     args = parser.parse_args()
-    lines = sys.stdin.readlines()
-    with sl.connect(os.path.join(args.db, "auths.db")) as c:
-        tracked = []
-        for l in lines:
-            if "->" in l:
-                t = make_tuple(l.split("->")[1].strip())
-                user = None
-                nasp = None
-                nasi = None
-                macs = []
-                for k in t:
-                    user = _get("User-Name", user, k)
-                    nasp = _get("NAS-Port", nasp, k)
-                    nasi = _get("NAS-IP-Address", nasi, k)
-                    mac = _get("Calling-Station-Id", None, k)
-                    if mac:
-                        macs.append(mac)
-                macs = list(set(macs))
-                for mac in macs:
-                    tracked.append(_object(user, nasp, nasi, mac))
-        _report(c, list(set(tracked)))
+    sender = notify.smirc_sender
+    if args.dry_run:
+        sender = notify.print_sender
+    notifier = notify.Digest(sender=sender,
+                             max_items=args.digest_size,
+                             max_wait=args.digest_wait)
+    conn = sl.connect(os.path.join(args.db, "auths.db"))
+    try:
+        _prepare(conn)
+        _report(conn, _tracked(sys.stdin), notifier)
+    finally:
+        conn.close()
 
 
 if __name__ == "__main__":
@@ -1,9 +1,45 @@
 #!/usr/bin/python
 """Testing harness for freepydius implementation."""
 import argparse
+import json
+import sys
+import timeit
 import wrapper
 
 
+def _attributes(attrs):
+    """request attributes (list of pairs or object) as radiusd tuples."""
+    if isinstance(attrs, dict):
+        attrs = sorted(attrs.items())
+    return tuple((str(x[0]), str(x[1])) for x in attrs)
+
+
+def _batch(source, output, choices):
+    """run {method, attributes} records (jsonl), writing jsonl results."""
+    wrapper.freepydius._ECHO_DEFAULT = False
+    wrapper.radiusd.radlog = lambda level, msg: None
+    failed = 0
+    for line in source:
+        if len(line.strip()) == 0:
+            continue
+        result = {}
+        start = timeit.default_timer()
+        try:
+            obj = json.loads(line)
+            result["method"] = obj["method"]
+            if obj["method"] not in choices:
+                raise Exception("unknown method: " + obj["method"])
+            attrs = _attributes(obj.get("attributes", []))
+            call = getattr(wrapper.freepydius, obj["method"])
+            result["result"] = call(attrs)
+        except Exception as e:
+            result["error"] = str(e)
+            failed += 1
+        result["elapsed_ms"] = (timeit.default_timer() - start) * 1000
+        output.write(json.dumps(result, sort_keys=True) + "\n")
+    return failed
+
+
 def main():
     """main entry."""
     options = dir(wrapper.freepydius)
@@ -27,12 +63,20 @@ def main():
             continue
         choices.append(opt)
     parser = argparse.ArgumentParser(description="freepyidus test harness")
-    parser.add_argument('method', choices=choices, help="method to execute")
+    parser.add_argument('method',
+                        nargs='?',
+                        choices=choices,
+                        help="method to execute")
     parser.add_argument('kv', nargs='*', help="key/value pairs")
     parser.add_argument('--json', default="../network.json",
                         help="network config")
     parser.add_argument('--keyfile', required=True)
+    parser.add_argument('--batch',
+                        help="jsonl file ('-' for stdin) of "
+                             "{method, attributes} records")
     args = parser.parse_args()
+    if args.method is None and args.batch is None:
+        parser.error("method or --batch is required")
     kv = []
     wrapper.radiusd.config = ()
     for val in args.kv:
@@ -45,6 +89,16 @@ def main():
     tuples = tuple(tuple(x) for x in kv)
     wrapper.freepydius._CONFIG_FILE = args.json
     wrapper.freepydius._ENC_KEY_FILE = args.keyfile
+    if args.batch is not None:
+        failed = 0
+        if args.batch == "-":
+            failed = _batch(sys.stdin, sys.stdout, choices)
+        else:
+            with open(args.batch, 'r') as f:
+                failed = _batch(f, sys.stdout, choices)
+        if failed > 0:
+            exit(1)
+        return
     attr = getattr(wrapper.freepydius, args.method)
     res = attr(tuples)
     print(res)
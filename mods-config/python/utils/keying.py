@@ -9,15 +9,18 @@ def _key(key):
     return [ord(x) for x in key]
 
 
-def change_password(old_key, new_key, password):
-    """change a password."""
-    old = password
+def change_password(old_key, new_key, passwords):
+    """change (a batch of) passwords."""
+    olds = passwords
     if old_key is not None:
-        old = wrapper.decrypt(old, wrapper.convert_key(old_key))
-    print("was: {}".format(password))
-    print("decrypted: {}".format(old))
+        olds = wrapper.decrypt_many(passwords, wrapper.convert_key(old_key))
+    for password, old in zip(passwords, olds):
+        print("was: {}".format(password))
+        print("decrypted: {}".format(old))
     print("now:")
-    print(wrapper.encrypt(old, wrapper.convert_key(new_key)))
+    for encrypted in wrapper.encrypt_many(olds,
+                                          wrapper.convert_key(new_key)):
+        print(encrypted)
 
 
 def main():
@@ -25,7 +28,10 @@ def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("--oldkey", type=str)
     parser.add_argument("--newkey", required=True, type=str)
-    parser.add_argument("--password", required=True, type=str)
+    parser.add_argument("--password",
+                        required=True,
+                        type=str,
+                        action="append")
     args = parser.parse_args()
     change_password(args.oldkey, args.newkey, args.password)
 
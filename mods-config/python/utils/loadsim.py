@@ -0,0 +1,292 @@
+#!/usr/bin/python
+"""Concurrent load simulation of freepydius (as rlm_python drives it)."""
+import argparse
+import json
+import os
+import random
+import re
+import resource
+import shutil
+import tempfile
+import threading
+import timeit
+from multiprocessing.pool import ThreadPool
+import wrapper
+import synth
+
+RADIUSD_CONF = os.path.join("..", "..", "..", "radiusd.conf")
+DEFAULT_THREADS = 32
+NAS_IP = "10.0.0.{}"
+
+
+class TimedLock(object):
+    """Lock proxy that accumulates time spent waiting to acquire."""
+
+    def __init__(self, lock):
+        """Init the instance."""
+        self.lock = lock
+        self.waited = 0.0
+        self.acquires = 0
+        self.slowest = 0.0
+
+    def acquire(self, *args):
+        """Acquire, timing the wait."""
+        start = timeit.default_timer()
+        res = self.lock.acquire(*args)
+        self.record(timeit.default_timer() - start)
+        return res
+
+    def record(self, waited):
+        """Account for a wait."""
+        self.waited += waited
+        self.acquires += 1
+        if waited > self.slowest:
+            self.slowest = waited
+
+    def release(self):
+        """Release."""
+        self.lock.release()
+
+    def __enter__(self):
+        """Context entry."""
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        """Context exit."""
+        self.release()
+
+
+def thread_pool_size(conf):
+    """Get max_servers of the radiusd.conf thread pool (or the default)."""
+    if not os.path.exists(conf):
+        return DEFAULT_THREADS
+    in_pool = False
+    with open(conf, 'r') as f:
+        for line in f:
+            text = line.split("#")[0].strip()
+            if text.startswith("thread pool"):
+                in_pool = True
+            elif in_pool and text.startswith("}"):
+                break
+            elif in_pool:
+                match = re.match(r"max_servers\s*=\s*(\d+)", text)
+                if match:
+                    return int(match.group(1))
+    return DEFAULT_THREADS
+
+
+def _timed_submit(writer):
+    """Time trace submits (the queue mutex and any queue-full wait)."""
+    timed = TimedLock(None)
+    submit = writer.submit
+
+    def _submit(*args):
+        start = timeit.default_timer()
+        submit(*args)
+        timed.record(timeit.default_timer() - start)
+    writer.submit = _submit
+    return timed
+
+
+def _instrument(mod):
+    """Swap the module locks (and trace queue submits) for timed proxies."""
+    locks = {}
+    if mod._writer is not None:
+        locks["trace queue"] = _timed_submit(mod._writer)
+    mod._config_lock = locks["config"] = TimedLock(mod._config_lock)
+    for name in dir(mod):
+        obj = getattr(mod, name)
+        if isinstance(obj, mod._LRU):
+            obj._lock = locks[name.strip("_")] = TimedLock(obj._lock)
+    return locks
+
+
+def _request(user, mac, nas, port):
+    """Request attributes as radiusd hands them over."""
+    return (("User-Name", user),
+            ("Calling-Station-Id", mac),
+            ("NAS-IP-Address", nas),
+            ("NAS-Port", str(port)))
+
+
+def _timed(results, stage, call, p):
+    """Call a stage, recording its latency."""
+    start = timeit.default_timer()
+    res = call(p)
+    results.append((stage, timeit.default_timer() - start))
+    return res
+
+
+def _login(args):
+    """One login: PEAP rounds (or mac-auth), post_auth, accounting."""
+    mod, login, rounds = args
+    user, mac, nas, port, bypassed = login
+    results = []
+    p = _request(user, mac, nas, port)
+    total = 1 if bypassed else rounds
+    for idx in range(total):
+        req = p
+        if idx > 0:
+            req = p + (("State", "0x{:08x}".format(idx)),)
+        _timed(results, "authorize", mod.authorize, req)
+    res = _timed(results, "post_auth", mod.post_auth, p)
+    acct = p + (("Acct-Status-Type", "Start"),)
+    _timed(results, "accounting", mod.accounting, acct)
+    return (results, res == wrapper.radiusd.RLM_MODULE_OK)
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of sorted values."""
+    if len(values) == 0:
+        return 0.0
+    idx = int(round(pct / 100.0 * (len(values) - 1)))
+    return values[idx]
+
+
+def _logins(population, count, nases, seed):
+    """Pick logins (user and bypass devices) from a population."""
+    rand = random.Random(seed)
+    users = population.logins
+    devices = population.bypassed
+    share = float(len(devices)) / max(1, len(devices) + len(users))
+    picked = []
+    for _ in range(count):
+        nas = NAS_IP.format(rand.randint(1, nases))
+        port = rand.randint(1, 48)
+        if len(devices) > 0 and rand.random() < share:
+            mac = rand.choice(devices)
+            picked.append((mac, mac, nas, port, True))
+        else:
+            user, mac = rand.choice(users)
+            picked.append((user, mac, nas, port, False))
+    return picked
+
+
+def simulate(population, logins, threads, rounds, folder):
+    """Run the simulation, returns a result summary."""
+    mod = wrapper.freepydius
+    config, keyfile = population.write(folder)
+    mod._CONFIG_FILE = config
+    mod._ENC_KEY_FILE = keyfile
+    mod._LOG_FILE = os.path.join(folder, wrapper.LOG_FILE)
+    mod._SEEN_FILE = os.path.join(folder, wrapper.SEEN_FILE)
+    mod._ECHO_DEFAULT = False
+    wrapper.radiusd.config = ()
+    wrapper.radiusd.radlog = lambda level, msg: None
+    mod.instantiate(())
+    locks = _instrument(mod)
+    pool = ThreadPool(threads)
+    work = [(mod, login, rounds) for login in logins]
+    start = timeit.default_timer()
+    outcomes = pool.map(_login, work, chunksize=16)
+    elapsed = timeit.default_timer() - start
+    pool.close()
+    pool.join()
+    writer = mod._writer
+    dropped = writer.dropped if writer is not None else 0
+    mod.detach()
+    stages = {}
+    accepted = 0
+    for results, ok in outcomes:
+        if ok:
+            accepted += 1
+        for stage, latency in results:
+            stages.setdefault(stage, []).append(latency)
+    summary = {"threads": threads,
+               "logins": len(logins),
+               "accepted": accepted,
+               "seconds": elapsed,
+               "calls": sum(len(x) for x in stages.values()),
+               "trace_dropped": dropped,
+               "rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               "stages": {},
+               "locks": {}}
+    summary["calls_per_sec"] = summary["calls"] / elapsed
+    summary["logins_per_sec"] = len(logins) / elapsed
+    for stage in stages:
+        values = sorted(stages[stage])
+        summary["stages"][stage] = {"calls": len(values),
+                                    "p50_ms": percentile(values, 50) * 1000,
+                                    "p95_ms": percentile(values, 95) * 1000,
+                                    "p99_ms": percentile(values, 99) * 1000}
+    for name in locks:
+        lock = locks[name]
+        summary["locks"][name] = {"acquires": lock.acquires,
+                                  "wait_ms": lock.waited * 1000,
+                                  "max_ms": lock.slowest * 1000}
+    return summary
+
+
+def _report(summary):
+    """Print a human readable summary."""
+    print("threads: {threads}, logins: {logins} ({accepted} accepted), "
+          "calls: {calls} in {seconds:.2f}s".format(**summary))
+    print("throughput: {calls_per_sec:.1f} calls/s, "
+          "{logins_per_sec:.1f} logins/s".format(**summary))
+    print("rss: {rss_kb} KB, trace records dropped: "
+          "{trace_dropped}".format(**summary))
+    print("| stage | calls | p50 (ms) | p95 (ms) | p99 (ms) |")
+    print("| ---   | ---   | ---      | ---      | ---      |")
+    for stage in sorted(summary["stages"].keys()):
+        s = summary["stages"][stage]
+        row = "| {} | {} | {:.3f} | {:.3f} | {:.3f} |"
+        print(row.format(stage,
+                         s["calls"],
+                         s["p50_ms"],
+                         s["p95_ms"],
+                         s["p99_ms"]))
+    print("| lock | acquires | wait (ms) | max (ms) |")
+    print("| ---  | ---      | ---       | ---      |")
+    for name in sorted(summary["locks"].keys()):
+        lock = summary["locks"][name]
+        row = "| {} | {} | {:.3f} | {:.3f} |"
+        print(row.format(name,
+                         lock["acquires"],
+                         lock["wait_ms"],
+                         lock["max_ms"]))
+
+
+def main():
+    """Main entry."""
+    parser = argparse.ArgumentParser(description="freepydius load sim")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--macs", type=int, default=2,
+                        help="macs per user")
+    parser.add_argument("--bypass", type=float, default=0.1,
+                        help="bypass devices (share of users)")
+    parser.add_argument("--vlans", type=int, default=4)
+    parser.add_argument("--rounds", type=int, default=8,
+                        help="PEAP authorize round trips per login")
+    parser.add_argument("--logins", type=int, default=5000)
+    parser.add_argument("--nas", type=int, default=10,
+                        help="number of NAS devices")
+    parser.add_argument("--threads", type=int, default=None,
+                        help="default: radiusd.conf thread pool size")
+    parser.add_argument("--radiusd-conf", type=str, default=RADIUSD_CONF)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", type=str, default=None,
+                        help="also write the summary as json")
+    args = parser.parse_args()
+    threads = args.threads
+    if threads is None:
+        threads = thread_pool_size(args.radiusd_conf)
+    population = synth.generate(users=args.users,
+                                macs=args.macs,
+                                bypass=args.bypass,
+                                vlans=args.vlans,
+                                seed=args.seed)
+    logins = _logins(population, args.logins, args.nas, args.seed)
+    folder = tempfile.mkdtemp()
+    try:
+        summary = simulate(population, logins, threads, args.rounds, folder)
+    finally:
+        shutil.rmtree(folder)
+    _report(summary)
+    if args.json is not None:
+        with open(args.json, 'w') as f:
+            f.write(json.dumps(summary, sort_keys=True, indent=4))
+
+
+if __name__ == "__main__":
+    main()
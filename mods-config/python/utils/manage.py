@@ -31,6 +31,7 @@ GEN_PSWD = "password"
 FILE_NAME = wrapper.CONFIG_NAME
 PREV_FILE = FILE_NAME + ".prev"
 AUDIT = "audit.csv"
+COMPOSE_CACHE = "compose.cache"
 USER_FOLDER = "users/"
 PYTHON_MODS = "mods-config/python"
 
@@ -184,6 +185,8 @@ def compose(env):
                    os.path.join(here, FILE_NAME),
                    "--audit",
                    os.path.join(here, AUDIT)]
+    if env.working_dir is not None:
+        composition += ["--cache", env.working_dir + COMPOSE_CACHE]
     call(composition, "compose configuration", working_dir=offset)
 
 
@@ -508,10 +511,13 @@ def daily_report(env, running_config):
     with open(report_indicator, 'w') as f:
         f.write("")
     output = env.working_dir + "auths.md"
+    source = ["--state", env.working_dir + "auths.db"]
+    if os.path.exists(wrapper.SEEN):
+        source = ["--seen", wrapper.SEEN]
     call(["python",
           "report_auths.py",
           "--output",
-          output],
+          output] + source,
          "report authorizations",
          working_dir=_get_utils(env))
     auths = None
@@ -0,0 +1,91 @@
+#!/usr/bin/python
+"""Digest-batched, asynchronous notifications."""
+import threading
+import time
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+def smirc_sender(text):
+    """Send via smirc (the default)."""
+    import smirc
+    smirc.run(arguments=[text])
+
+
+def print_sender(text):
+    """Local stand-in sender."""
+    print(text)
+
+
+class Digest(object):
+    """Collect messages into size/time bounded digests sent off-thread."""
+
+    def __init__(self,
+                 sender=smirc_sender,
+                 max_items=50,
+                 max_wait=30.0,
+                 retries=5,
+                 backoff=1.0):
+        """Start the sending worker."""
+        self.sender = sender
+        self.max_items = max_items
+        self.max_wait = max_wait
+        self.retries = retries
+        self.backoff = backoff
+        self.sent = 0
+        self.failed = []
+        self.errors = []
+        self._queue = queue.Queue()
+        self._worker = threading.Thread(target=self._run,
+                                        name="notify-digest")
+        self._worker.daemon = True
+        self._worker.start()
+
+    def add(self, key, text):
+        """Queue a message (key is reported back if it can't be sent)."""
+        self._queue.put((key, text))
+
+    def close(self):
+        """Send anything queued and wait for the worker."""
+        self._queue.put(None)
+        self._worker.join()
+
+    def _run(self):
+        """Gather digests until closed."""
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = time.time() + self.max_wait
+            while len(batch) < self.max_items:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(True, remaining)
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            self._send(batch)
+
+    def _send(self, batch):
+        """Send a digest, retrying with exponential backoff."""
+        text = "\n".join(x[1] for x in batch)
+        for attempt in range(self.retries + 1):
+            try:
+                self.sender(text)
+                self.sent += 1
+                return
+            except Exception as e:
+                error = str(e)
+                if attempt < self.retries:
+                    time.sleep(self.backoff * (2 ** attempt))
+        self.errors.append(error)
+        self.failed.extend(x[0] for x in batch)
@@ -1,11 +1,18 @@
 #!/usr/bin/python
 """log replay for trace logging."""
 import argparse
-import ast
-import subprocess
+import threading
+import time
+import timeit
+from multiprocessing.pool import ThreadPool
 import wrapper
+import tracelog
 
-KEY = " -> "
+METHODS = {"AUTHENTICATE": "authenticate",
+           "AUTHORIZE": "authorize",
+           "POSTAUTH": "post_auth",
+           "ACCOUNTING": "accounting"}
+IN_FLIGHT = 4
 
 
 def _commented(text):
@@ -13,42 +20,132 @@ def _commented(text):
     print("# " + text)
 
 
+def _outcome(method, res):
+    """summarize a stage result as a decision."""
+    if method == "authorize":
+        if len(res[1]) > 0:
+            return "vlan"
+        if len(res[2]) > 0:
+            return "password"
+        return "none"
+    if res == wrapper.radiusd.RLM_MODULE_OK:
+        return "ok"
+    if res == wrapper.radiusd.RLM_MODULE_REJECT:
+        return "reject"
+    return str(res)
+
+
+class Replay(object):
+    """replays requests in-process against the stage functions."""
+
+    def __init__(self, workers, speed):
+        """init the instance."""
+        self.speed = speed
+        self.pool = ThreadPool(workers)
+        self.slots = threading.Semaphore(workers * IN_FLIGHT)
+        self.lock = threading.Lock()
+        self.latency = {}
+        self.outcomes = {}
+        self.errors = 0
+        self.unknown = 0
+
+    def _call(self, method, attrs):
+        """call a stage, recording latency and decision."""
+        try:
+            call = getattr(wrapper.freepydius, method)
+            start = timeit.default_timer()
+            try:
+                res = call(attrs)
+            except Exception as e:
+                with self.lock:
+                    self.errors += 1
+                _commented("error: {} {} ({})".format(method, attrs, e))
+                return
+            elapsed = timeit.default_timer() - start
+            outcome = _outcome(method, res)
+            with self.lock:
+                self.latency.setdefault(method, []).append(elapsed)
+                counts = self.outcomes.setdefault(method, {})
+                counts[outcome] = counts.get(outcome, 0) + 1
+        finally:
+            self.slots.release()
+
+    def run(self, records):
+        """replay (request) records, paced by their timestamps."""
+        first = None
+        start = time.time()
+        for record in records:
+            if not tracelog.is_request(record):
+                continue
+            method = METHODS.get(record.stage)
+            if method is None:
+                self.unknown += 1
+                _commented("unknown method: " + record.stage)
+                continue
+            if self.speed > 0:
+                if first is None:
+                    first = record.ts
+                due = start + (record.ts - first) / self.speed
+                wait = due - time.time()
+                if wait > 0:
+                    time.sleep(wait)
+            self.slots.acquire()
+            self.pool.apply_async(self._call,
+                                  (method, tracelog.pairs(record)))
+        self.pool.close()
+        self.pool.join()
+        return time.time() - start
+
+    def report(self, elapsed):
+        """print per-stage latency and decisions."""
+        total = sum(len(x) for x in self.latency.values())
+        _commented("replayed {} requests in {:.2f}s".format(total, elapsed))
+        print("| stage | calls | p50 (ms) | p95 (ms) | p99 (ms) | decisions |")
+        print("| ---   | ---   | ---      | ---      | ---      | ---       |")
+        for method in sorted(self.latency.keys()):
+            values = sorted(self.latency[method])
+            counts = self.outcomes[method]
+            decisions = ", ".join("{}={}".format(k, counts[k])
+                                  for k in sorted(counts.keys()))
+            cols = [method, str(len(values))]
+            for pct in [50, 95, 99]:
+                idx = int(round(pct / 100.0 * (len(values) - 1)))
+                cols.append("{:.3f}".format(values[idx] * 1000))
+            cols.append(decisions)
+            print("| " + " | ".join(cols) + " |")
+        _commented("errors: {}, unknown: {}".format(self.errors,
+                                                    self.unknown))
+
+
 def main():
     """main entry point."""
     parser = argparse.ArgumentParser(description="freepyidus log replay")
     parser.add_argument('--file', help="file input", default=wrapper.LOG_NAME)
+    parser.add_argument('--json', default=wrapper.CONFIG,
+                        help="network config")
+    parser.add_argument('--keyfile', default=wrapper.freepydius._ENC_KEY_FILE)
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--speed', type=float, default=0,
+                        help="0 as fast as possible, 1 original timing, "
+                             "N for N times faster")
     args = parser.parse_args()
-    with open(args.file, 'r') as f:
-        for line in f:
-            idx = line.index(KEY)
-            meta = line[0:idx]
-            last = meta.rfind(":")
-            meta = meta[0:last]
-            typed = meta.split(" ")[-1]
-            data = ast.literal_eval(line[idx + len(KEY):])
-            objs = []
-            for d in data:
-                key = d[0]
-                val = d[1]
-                objs.append("=".join([str(key), str(val)]))
-            _commented("replaying")
-            method = None
-            if typed == "AUTHORIZE":
-                method = "authorize"
-            elif typed == "POSTAUTH":
-                method = "post_auth"
-            elif typed == "ACCOUNTING":
-                method = "accounting"
-            else:
-                print("unknown method: " + method)
-                exit(-1)
-            cmd = ["python", "harness.py", method]
-            for item in objs:
-                cmd.append(item)
-            _commented(method)
-            print(_commented(" ".join(cmd)))
-            subprocess.Popen(cmd)
-            print("")
+    wrapper.radiusd.config = ()
+    wrapper.radiusd.radlog = lambda level, msg: None
+    wrapper.freepydius._ECHO_DEFAULT = False
+    wrapper.freepydius._CONFIG_FILE = args.json
+    wrapper.freepydius._ENC_KEY_FILE = args.keyfile
+    try:
+        wrapper.freepydius._current()
+    except Exception as e:
+        _commented("error: unable to load {} ({})".format(args.json, e))
+        exit(1)
+    replay = Replay(args.workers, args.speed)
+    caught = wrapper.freepydius._stage_errors
+    elapsed = replay.run(tracelog.read(args.file))
+    replay.errors += wrapper.freepydius._stage_errors - caught
+    replay.report(elapsed)
+    if replay.errors > 0 or replay.unknown > 0:
+        exit(1)
 
 
 if __name__ == '__main__':
@@ -4,58 +4,214 @@ import datetime as dt
 import argparse
 import json
 import wrapper
+import tracelog
 import os
+import sqlite3
+import time
+from multiprocessing import Pool
 
-_KEY = "->"
 _NA = "n/a"
 _DENY = "denied"
+_ACCEPT = "?"
+_RESPONSE = ""
+_TABLES = ["checkpoints", "seen", "ids"]
+_SCHEMA = ["""CREATE TABLE IF NOT EXISTS checkpoints (
+              day TEXT PRIMARY KEY,
+              path TEXT NOT NULL,
+              inode INTEGER NOT NULL,
+              offset INTEGER NOT NULL)""",
+           """CREATE TABLE IF NOT EXISTS seen (
+              day TEXT NOT NULL,
+              user TEXT NOT NULL,
+              mac TEXT NOT NULL,
+              result TEXT,
+              PRIMARY KEY (day, user, mac))""",
+           """CREATE TABLE IF NOT EXISTS ids (
+              day TEXT NOT NULL,
+              id TEXT NOT NULL,
+              user TEXT NOT NULL,
+              mac TEXT NOT NULL,
+              PRIMARY KEY (day, id))"""]
 
 
-def _new_key(user, mac):
-    """Create a key."""
-    return "{}{}{}".format(user, _KEY, mac)
+def _day(job):
+    """Scan a day's log past an offset into its (user, mac) -> result map.
+
+    Request ids are only returned when given (to store state), the full
+    window parse passes None to keep them in the worker.
+    """
+    day_offset, file_name, offset, uuid_log, seen = job
+    ids = uuid_log if uuid_log is not None else {}
+    for record, offset in tracelog.read_from(file_name, offset):
+        uuid = record.id
+        attrs = tracelog.pairs(record)
+        is_accept = tracelog.value(record, "Tunnel-Type") is not None
+        is_response = ("Response", 2) in attrs
+        if is_accept or is_response:
+            key = ids.get(uuid)
+            if key is not None:
+                if is_response:
+                    seen[key] = _RESPONSE
+                elif seen.get(key) != _RESPONSE:
+                    seen[key] = _ACCEPT
+        else:
+            user_start = tracelog.value(record, "User-Name")
+            calling = tracelog.value(record, "Calling-Station-Id")
+            if user_start is not None and calling is not None:
+                key = (user_start, wrapper.convert_mac(calling))
+                ids[uuid] = key
+                if key not in seen:
+                    seen[key] = None
+    return offset, uuid_log, seen
+
+
+def _merge(day_offset, seen, auth_info):
+    """Merge a day's partial map (days must be merged oldest first)."""
+    for key in seen:
+        result = seen[key]
+        if key not in auth_info:
+            auth_info[key] = "{} ({})".format(_DENY, day_offset)
+        if result is not None:
+            auth_info[key] = day_offset + result
+
+
+def _find(logs, day_offset):
+    """Find a day's log (reporting it when missing)."""
+    name = "trace.log.{}".format(day_offset)
+    file_name = tracelog.find(logs, name)
+    if file_name is None:
+        print("{} does not exist".format(os.path.join(logs, name)))
+    return file_name
+
+
+def _run(jobs, workers):
+    """Scan jobs in order (in worker processes unless workers is 1)."""
+    if workers == 1 or len(jobs) < 2:
+        return [_day(x) for x in jobs]
+    pool = Pool(workers)
+    try:
+        return pool.map(_day, jobs, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _parse(days, logs, workers, auth_info):
+    """Parse the full window of logs."""
+    jobs = []
+    for day_offset in days:
+        file_name = _find(logs, day_offset)
+        if file_name is not None:
+            jobs.append((day_offset, file_name, 0, None, {}))
+    for job, scanned in zip(jobs, _run(jobs, workers)):
+        _merge(job[0], scanned[2], auth_info)
+
+
+def _is_compressed(file_name):
+    """Check if a log is a compressed rotation."""
+    return file_name.endswith(tuple(tracelog.COMPRESSED))
 
 
-def _file(day_offset, auth_info, logs):
-    """Read a file."""
+def _resume(db, day_offset, file_name):
+    """(offset, done) to resume a day's log at (reset if replaced)."""
+    row = db.execute("SELECT path, inode, offset FROM checkpoints "
+                     "WHERE day = ?", (day_offset,)).fetchone()
+    if row is not None:
+        path, inode, offset = row
+        if path == file_name:
+            if _is_compressed(file_name):
+                # rotations are compressed once complete
+                return offset, True
+            stat = os.stat(file_name)
+            if stat.st_ino == inode and stat.st_size >= offset:
+                return offset, stat.st_size == offset
+        elif path == os.path.splitext(file_name)[0]:
+            # compressed by logrotate, offsets are of the uncompressed bytes
+            return offset, False
+    for table in _TABLES:
+        db.execute("DELETE FROM {} WHERE day = ?".format(table),
+                   (day_offset,))
+    return 0, False
+
+
+def _load(db, day_offset):
+    """Stored request ids and partial map of a day."""
     uuid_log = {}
-    file_name = os.path.join(logs, "trace.log.{}".format(day_offset))
-    if not os.path.exists(file_name):
-        print("{} does not exist".format(file_name))
-        return
-    with open(file_name, 'r') as f:
-        for l in f:
-            parts = l.split("->")
-            uuid = parts[0].split(":")[3].strip()
-            data = parts[1]
-            is_accept = "Tunnel-Type" in data
-            is_response = "('Response', 2)" in data
-            if is_accept or is_response:
-                if uuid in uuid_log:
-                    user = uuid_log[uuid]
-                    auth_cur = auth_info[user]
-                    if auth_cur != day_offset:
-                        auth_info[user] = day_offset
-                        if is_accept:
-                            auth_info[user] += "?"
-            else:
-                if "User-Name" in data:
-                    idx = data.index("User-Name") + 13
-                    user_start = data[idx:]
-                    user_start = user_start[:user_start.index(")") - 1]
-                    calling = None
-                    if "Calling-Station-Id" in data:
-                        calling_station = data.index("Calling-Station-Id") + 22
-                        calling = data[calling_station:]
-                        calling = calling[:calling.index(")") - 1]
-                        calling = calling.replace(":",
-                                                  "").replace("-",
-                                                              "").lower()
-                        key = _new_key(user_start, calling)
-                        uuid_log[uuid] = key
-                        if key not in auth_info:
-                            auth_info[key] = "{} ({})".format(_DENY,
-                                                              day_offset)
+    for row in db.execute("SELECT id, user, mac FROM ids "
+                          "WHERE day = ?", (day_offset,)):
+        uuid_log[row[0]] = (row[1], row[2])
+    seen = {}
+    for row in db.execute("SELECT user, mac, result FROM seen "
+                          "WHERE day = ?", (day_offset,)):
+        seen[(row[0], row[1])] = row[2]
+    return uuid_log, seen
+
+
+def _store(db, job, scanned):
+    """Store a day's scan and its checkpoint."""
+    day_offset = job[0]
+    file_name = job[1]
+    offset, uuid_log, seen = scanned
+    db.execute("INSERT OR REPLACE INTO checkpoints VALUES (?, ?, ?, ?)",
+               (day_offset, file_name, os.stat(file_name).st_ino, offset))
+    db.executemany("INSERT OR REPLACE INTO ids VALUES (?, ?, ?, ?)",
+                   ((day_offset, x, uuid_log[x][0], uuid_log[x][1])
+                    for x in uuid_log))
+    db.executemany("INSERT OR REPLACE INTO seen VALUES (?, ?, ?, ?)",
+                   ((day_offset, x[0], x[1], seen[x]) for x in seen))
+
+
+def _update(state, days, logs, workers, auth_info):
+    """Read only new log bytes into the state store, merge from the store."""
+    db = sqlite3.connect(state)
+    try:
+        db.execute("PRAGMA journal_mode=WAL")
+        for stmt in _SCHEMA:
+            db.execute(stmt)
+        jobs = []
+        found = []
+        for day_offset in days:
+            file_name = _find(logs, day_offset)
+            if file_name is None:
+                continue
+            found.append(day_offset)
+            offset, done = _resume(db, day_offset, file_name)
+            if done:
+                # responses can no longer arrive for a complete log
+                db.execute("DELETE FROM ids WHERE day = ?", (day_offset,))
+                continue
+            uuid_log, seen = _load(db, day_offset)
+            jobs.append((day_offset, file_name, offset, uuid_log, seen))
+        for job, scanned in zip(jobs, _run(jobs, workers)):
+            _store(db, job, scanned)
+        for table in _TABLES:
+            db.execute("DELETE FROM {} WHERE day < ?".format(table),
+                       (days[0],))
+        db.commit()
+        for day_offset in found:
+            _merge(day_offset, _load(db, day_offset)[1], auth_info)
+    finally:
+        db.close()
+
+
+def _seen(seen_file, days, auth_info):
+    """Merge the last seen table maintained by freepydius post_auth."""
+    start = dt.datetime.strptime(days[0], "%Y-%m-%d")
+    since = time.mktime(start.timetuple())
+    db = sqlite3.connect(seen_file)
+    try:
+        rows = db.execute("SELECT user, mac, last_accept, last_reject "
+                          "FROM seen WHERE last_accept >= ? OR "
+                          "last_reject >= ?", (since, since)).fetchall()
+    finally:
+        db.close()
+    for user, mac, accept, reject in rows:
+        key = (user, mac)
+        if accept is not None and accept >= since:
+            auth_info[key] = "{}".format(dt.date.fromtimestamp(accept))
+        elif key not in auth_info:
+            auth_info[key] = "{} ({})".format(_DENY,
+                                              dt.date.fromtimestamp(reject))
 
 
 def main():
@@ -71,6 +227,20 @@ def main():
     parser.add_argument("--logs",
                         type=str,
                         default="/var/log/radius/freepydius")
+    parser.add_argument("--workers",
+                        type=int,
+                        default=None,
+                        help="day parsing processes (default cpu count)")
+    parser.add_argument("--state",
+                        type=str,
+                        default=None,
+                        help="sqlite store of parsed days and log offsets "
+                             "(only new log bytes are read)")
+    parser.add_argument("--seen",
+                        type=str,
+                        default=None,
+                        help="report from the freepydius last seen table "
+                             "instead of the trace logs")
     args = parser.parse_args()
     config = None
     authd = {}
@@ -79,18 +249,23 @@ def main():
         users = j[wrapper.USERS]
         for u in users:
             for m in users[u][wrapper.MACS]:
-                k = _new_key(u, m)
-                authd[k] = _NA
+                authd[(u, m)] = _NA
     today = dt.date.today()
-    for x in reversed(range(1, args.days + 1)):
-        _file("{}".format(today - dt.timedelta(days=x)), authd, args.logs)
+    days = ["{}".format(today - dt.timedelta(days=x))
+            for x in reversed(range(1, args.days + 1))]
+    if args.seen is not None:
+        _seen(args.seen, days, authd)
+    elif args.state is None:
+        _parse(days, args.logs, args.workers, authd)
+    else:
+        _update(args.state, days, args.logs, args.workers, authd)
     lines = []
     lines.append("| user | mac | last |")
     lines.append("| ---  | --- | ---  |")
     denied = []
     cruft = []
     rest = []
-    for item in sorted(authd.keys()):
+    for item in sorted(authd.keys(), key=lambda x: x[0] + "->" + x[1]):
         val = authd[item]
         if _NA in val:
             cruft.append(item)
@@ -100,10 +275,9 @@ def main():
             rest.append(item)
     for item in denied + cruft + rest:
         on = authd[item]
-        parts = item.split(_KEY)
         if on is None:
             on = ""
-        lines.append("| {} | {} | {} |".format(parts[0], parts[1], on))
+        lines.append("| {} | {} | {} |".format(item[0], item[1], on))
     if args.output is None:
         for l in lines:
             print(l)
@@ -0,0 +1,77 @@
+#!/usr/bin/python
+"""Synthetic network configurations for load and benchmark tooling."""
+import json
+import os
+import random
+import string
+import wrapper
+
+KEY_CHARS = string.ascii_letters + string.digits
+PASSWORD_LENGTH = 32
+
+
+class Population(object):
+    """Generated users/devices and the config that serves them."""
+
+    def __init__(self, config, key, logins, bypassed):
+        """Init the instance."""
+        self.config = config
+        self.key = key
+        self.logins = logins
+        self.bypassed = bypassed
+
+    def write(self, folder):
+        """Write network.json and keyfile, returns (config, keyfile)."""
+        config = os.path.join(folder, wrapper.CONFIG_NAME)
+        keyfile = os.path.join(folder, "keyfile")
+        with open(config, 'w') as f:
+            f.write(json.dumps(self.config))
+        with open(keyfile, 'w') as f:
+            f.write(self.key)
+        return (config, keyfile)
+
+
+def _mac(rand):
+    """Random (lowercase, unseparated) mac."""
+    return "{:012x}".format(rand.getrandbits(48))
+
+
+def _text(rand, length):
+    """Random text."""
+    return "".join(rand.choice(KEY_CHARS) for _ in range(length))
+
+
+def generate(users=1000, macs=2, bypass=0.1, vlans=4, pad=0, seed=0):
+    """Generate a population.
+
+    users: user definitions, macs: devices per user, bypass: share of
+    devices (relative to users) that mac-authenticate, vlans: vlan count.
+    """
+    rand = random.Random(seed)
+    key = "{}:{}".format(pad * 2, _text(rand, PASSWORD_LENGTH * 2))
+    vlan_names = ["vlan{}".format(x) for x in range(vlans)]
+    passwords = [_text(rand, PASSWORD_LENGTH) for _ in range(users)]
+    encrypted = wrapper.encrypt_many(passwords, wrapper.convert_key(key))
+    config = {wrapper.USERS: {},
+              wrapper.VLANS: {},
+              wrapper.BYPASS: {}}
+    for idx, name in enumerate(vlan_names):
+        config[wrapper.VLANS][name] = str(10 + idx)
+    logins = []
+    for idx in range(users):
+        vlan = vlan_names[idx % vlans]
+        user = "{}.user{}".format(vlan, idx)
+        devices = [_mac(rand) for _ in range(macs)]
+        config[wrapper.USERS][user] = {wrapper.MACS: devices,
+                                       wrapper.PASS: encrypted[idx],
+                                       wrapper.ATTR: [],
+                                       wrapper.PORT: [],
+                                       wrapper.WILDCARD: []}
+        for mac in devices:
+            logins.append((user, mac))
+    bypassed = []
+    for idx in range(int(users * bypass)):
+        mac = _mac(rand)
+        config[wrapper.BYPASS][mac] = vlan_names[idx % vlans]
+        bypassed.append(mac)
+    return Population(config, key, logins, bypassed)
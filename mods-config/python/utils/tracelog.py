@@ -0,0 +1,189 @@
+#!/usr/bin/python
+"""Streaming reader for freepydius trace logs (text or JSONL lines)."""
+import ast
+import collections
+import datetime
+import gzip
+import io
+import json
+import os
+import time
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+TEXT_KEY = " -> "
+COMPRESSED = [".gz", ".zst"]
+REQUEST_KEYS = ["User-Name",
+                "Calling-Station-Id",
+                "NAS-IP-Address",
+                "Acct-Status-Type"]
+
+Record = collections.namedtuple("Record", ["ts", "stage", "id", "data"])
+
+_stamps = {}
+
+
+def _timestamp(text):
+    """Convert a logging asctime (local, with msecs) to epoch seconds."""
+    parts = text.split(",")
+    base = _stamps.get(parts[0])
+    if base is None:
+        as_date = datetime.datetime.strptime(parts[0], "%Y-%m-%d %H:%M:%S")
+        base = time.mktime(as_date.timetuple())
+        if len(_stamps) > 1024:
+            _stamps.clear()
+        _stamps[parts[0]] = base
+    if len(parts) > 1:
+        return base + int(parts[1]) / 1000.0
+    return base
+
+
+def _tuples(data):
+    """Convert JSON lists back into the tuples radiusd hands us."""
+    if isinstance(data, list):
+        return tuple(_tuples(x) for x in data)
+    return data
+
+
+def _parse_json(line):
+    """Parse a structured (JSONL) record."""
+    obj = json.loads(line)
+    return Record(obj["ts"], obj["stage"], obj["id"], _tuples(obj["data"]))
+
+
+def _parse_text(line):
+    """Parse a '<asctime> <STAGE>:<id> -> <data>' record."""
+    idx = line.index(TEXT_KEY)
+    meta = line[0:idx]
+    last = meta.rfind(":")
+    ident = meta[last + 1:].strip()
+    meta = meta[0:last]
+    space = meta.rfind(" ")
+    stage = meta[space + 1:]
+    raw = line[idx + len(TEXT_KEY):].rstrip("\r\n")
+    try:
+        data = ast.literal_eval(raw)
+    except (ValueError, SyntaxError):
+        data = raw
+    return Record(_timestamp(meta[0:space]), stage, ident, data)
+
+
+def parse(line):
+    """Parse a trace line of either format (None if not a record)."""
+    text = line.strip()
+    if len(text) == 0:
+        return None
+    try:
+        if text.startswith("{"):
+            return _parse_json(text)
+        return _parse_text(line)
+    except (ValueError, KeyError):
+        return None
+
+
+def stream(lines):
+    """Lazily parse records from an iterable of lines."""
+    for line in lines:
+        record = parse(line)
+        if record is not None:
+            yield record
+
+
+def _open_binary(file_name):
+    """Open a (possibly gzip/zstd rotated) trace log as bytes."""
+    if file_name.endswith(".gz"):
+        return gzip.open(file_name, 'rb')
+    if file_name.endswith(".zst"):
+        if zstandard is None:
+            raise Exception("zstandard is required to read " + file_name)
+        raw = open(file_name, 'rb')
+        return zstandard.ZstdDecompressor().stream_reader(raw)
+    return open(file_name, 'rb')
+
+
+def open_log(file_name):
+    """Open a (possibly gzip/zstd rotated) trace log as text."""
+    for ext in COMPRESSED:
+        if file_name.endswith(ext):
+            return io.TextIOWrapper(_open_binary(file_name))
+    return open(file_name, 'r')
+
+
+def find(folder, name):
+    """Find a log by name, plain or compressed (None if missing)."""
+    for ext in [""] + COMPRESSED:
+        path = os.path.join(folder, name + ext)
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def read(file_name):
+    """Lazily read the records of a trace log file."""
+    with open_log(file_name) as f:
+        for record in stream(f):
+            yield record
+
+
+def _lines(f, size=65536):
+    """Split complete lines from read() chunks (zstd streams can't iterate)."""
+    pending = b""
+    while True:
+        chunk = f.read(size)
+        if not chunk:
+            return
+        pending += chunk
+        start = 0
+        end = pending.find(b"\n")
+        while end >= 0:
+            yield pending[start:end + 1]
+            start = end + 1
+            end = pending.find(b"\n", start)
+        pending = pending[start:]
+
+
+def read_from(file_name, offset=0):
+    """Lazily read (record, end offset) of complete lines past an offset.
+
+    Offsets are of the uncompressed bytes, a trailing partial line (still
+    being written) is left for the next read.
+    """
+    with _open_binary(file_name) as f:
+        if offset > 0:
+            f.seek(offset)
+        for line in _lines(f):
+            offset += len(line)
+            record = parse(line.decode("utf-8", "replace"))
+            if record is not None:
+                yield record, offset
+
+
+def pairs(record):
+    """Get the (key, value) attribute pairs of a record."""
+    if not isinstance(record.data, tuple):
+        return ()
+    return tuple(x for x in record.data
+                 if isinstance(x, tuple) and len(x) == 2)
+
+
+def values(record, key):
+    """Get all values for an attribute key."""
+    return [x[1] for x in pairs(record) if x[0] == key]
+
+
+def value(record, key):
+    """Get the first value for an attribute key (or None)."""
+    for x in pairs(record):
+        if x[0] == key:
+            return x[1]
+    return None
+
+
+def is_request(record):
+    """Check if a record is a logged request (not a reply/result)."""
+    for x in pairs(record):
+        if x[0] in REQUEST_KEYS:
+            return True
+    return False
@@ -120,6 +120,11 @@ class Assignment(object):
                     return False
                 if mac in already_set:
                     return self.report("invalid port bypass mac")
+        if self.wildcard is not None:
+            for wildcard in self.wildcard:
+                if not wrapper.is_wildcard(wildcard):
+                    print('invalid wildcard detected {}'.format(wildcard))
+                    return False
         if len(self.macs) != len(set(self.macs)):
             return self.report("macs not unique")
         if self.disable is not None and len(self.disable) > 0:
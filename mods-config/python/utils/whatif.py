@@ -0,0 +1,134 @@
+#!/usr/bin/python
+"""Replay historical requests against the running and a candidate config."""
+import argparse
+import csv
+import datetime as dt
+import os
+import sys
+from multiprocessing import Pool
+import wrapper
+import tracelog
+
+LOG_PREFIX = wrapper.LOG_FILE + "."
+STAGES = ["AUTHORIZE", "POSTAUTH"]
+CHUNK = 10000
+_configs = None
+
+
+def _log_files(logs, days):
+    """trace.log.YYYY-MM-DD files (newest days first, limited)."""
+    found = []
+    for name in os.listdir(logs):
+        if not name.startswith(LOG_PREFIX):
+            continue
+        day = name[len(LOG_PREFIX):].split(".")[0]
+        try:
+            dt.datetime.strptime(day, "%Y-%m-%d")
+        except ValueError:
+            continue
+        found.append((day, os.path.join(logs, name)))
+    found = sorted(found, reverse=True)
+    if days is not None:
+        found = found[0:days]
+    return [x[1] for x in found]
+
+
+def _scan(file_name):
+    """unique (user, mac, nas, port) requests of one day."""
+    seen = set()
+    for record in tracelog.read(file_name):
+        if record.stage not in STAGES or not tracelog.is_request(record):
+            continue
+        user = tracelog.value(record, "User-Name")
+        if user is None:
+            continue
+        nas = tracelog.value(record, "NAS-IP-Address")
+        port = tracelog.value(record, "NAS-Port")
+        for mac in tracelog.values(record, "Calling-Station-Id"):
+            seen.add((user, wrapper.convert_mac(mac), nas, port))
+    return seen
+
+
+def _load(running, candidate):
+    """load both configs (per worker process)."""
+    global _configs
+    mod = wrapper.freepydius
+    _configs = [mod._load_snapshot(x, mod._signature(x), 1)
+                for x in [running, candidate]]
+
+
+def _decide(snapshot, user, mac):
+    """accept/vlan decision for a user and mac."""
+    mod = wrapper.freepydius
+    resolved = mod._resolve(user, credential=False, snapshot=snapshot)
+    if mod._matched(resolved, [mac]):
+        return resolved.vlan
+    return None
+
+
+def _evaluate(pairs):
+    """(user, mac) pairs whose decisions differ between the configs."""
+    changed = {}
+    for user, mac in pairs:
+        was = _decide(_configs[0], user, mac)
+        now = _decide(_configs[1], user, mac)
+        if was != now:
+            changed[(user, mac)] = (was, now)
+    return changed
+
+
+def _decision(vlan):
+    """printable decision."""
+    if vlan is None:
+        return "reject"
+    return "vlan " + vlan
+
+
+def main():
+    """main entry."""
+    parser = argparse.ArgumentParser(description="config what-if replay")
+    parser.add_argument("--candidate", type=str, required=True)
+    parser.add_argument("--running", type=str, default=wrapper.CONFIG)
+    parser.add_argument("--logs", type=str,
+                        default=os.path.dirname(wrapper.LOG_NAME))
+    parser.add_argument("--days", type=int, default=None,
+                        help="most recent N days (default all)")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--output", type=str, default=None)
+    args = parser.parse_args()
+    files = _log_files(args.logs, args.days)
+    if len(files) == 0:
+        print("no trace logs found")
+        exit(1)
+    pool = Pool(args.workers, _load, (args.running, args.candidate))
+    requests = set()
+    for day in pool.imap_unordered(_scan, files):
+        requests.update(day)
+    pairs = sorted(set((x[0], x[1]) for x in requests))
+    chunks = [pairs[i:i + CHUNK] for i in range(0, len(pairs), CHUNK)]
+    changed = {}
+    for part in pool.imap_unordered(_evaluate, chunks):
+        changed.update(part)
+    pool.close()
+    pool.join()
+    out = sys.stdout
+    if args.output is not None:
+        out = open(args.output, 'w')
+    try:
+        writer = csv.writer(out, lineterminator=os.linesep)
+        writer.writerow(["user", "mac", "nas", "port", "running", "candidate"])
+        for req in sorted(requests, key=lambda x: tuple(str(y) for y in x)):
+            diff = changed.get((req[0], req[1]))
+            if diff is None:
+                continue
+            writer.writerow(list(req) + [_decision(diff[0]),
+                                         _decision(diff[1])])
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    sys.stderr.write("{} files, {} unique requests, {} changed\n".format(
+        len(files), len(requests), len(changed)))
+
+
+if __name__ == "__main__":
+    main()
@@ -27,11 +27,36 @@ def decrypt(value, key):
     return freepydius._decrypt(value, key)
 
 
+def encrypt_many(values, key):
+    """encrypt many values in one batch."""
+    return freepydius._encrypt_many(values, key)
+
+
+def decrypt_many(values, key):
+    """decrypt many values in one batch."""
+    return freepydius._decrypt_many(values, key)
+
+
+def pack_config(obj):
+    """pack a composed config into the binary (mmap) layout."""
+    return freepydius._pack_config(obj)
+
+
+def sync_sqlite(path, obj):
+    """apply a composed config to a sqlite config (changed rows only)."""
+    return freepydius._sync_sqlite(path, obj)
+
+
 def is_mac(mac):
     """Check if an object is a mac."""
     return freepydius._mac(mac)
 
 
+def is_wildcard(wildcard):
+    """Check if an object is a usable wildcard (mac fragment)."""
+    return freepydius._wildcard_fragment(wildcard) is not None
+
+
 def convert_key(key):
     """Convert a key for encrypt/decrypt functions."""
     return freepydius._convert_key(key)
@@ -41,8 +66,13 @@ WILDCARD = freepydius.WILDCARD_KEY
 PORT = freepydius.PORT_BYPASS_KEY
 LOG_FILE = freepydius._LOG_FILE_NAME
 LOG_NAME = freepydius._LOG_FILE
+SEEN_FILE = freepydius._SEEN_FILE_NAME
+SEEN = freepydius._SEEN_FILE
 CONFIG = freepydius._CONFIG_FILE
 CONFIG_NAME = freepydius._CONFIG_FILE_NAME
 USERS = freepydius.USER_KEY
 MACS = freepydius.MAC_KEY
+PASS = freepydius.PASS_KEY
+VLANS = freepydius.VLAN_KEY
+BYPASS = freepydius.BYPASS_KEY
 ATTR = freepydius.ATTR_KEY